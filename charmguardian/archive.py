@@ -0,0 +1,77 @@
+import logging
+import os
+import stat
+import zipfile
+
+log = logging.getLogger(__name__)
+
+
+class UnsafeArchiveError(ValueError):
+    """An archive member would be written outside the extraction dir."""
+
+
+def member_path(info, dest):
+    """Return the path ZipFile.extract would write member `info` to."""
+    arcname = info.filename.replace('/', os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(
+        x for x in arcname.split(os.path.sep)
+        if x not in ('', os.path.curdir, os.path.pardir))
+    return os.path.join(dest, arcname)
+
+
+def is_within(path, dir_):
+    """Return True if `path`, with symlinks resolved, is inside `dir_`."""
+    dir_ = os.path.realpath(dir_)
+    path = os.path.realpath(path)
+    return path == dir_ or path.startswith(dir_ + os.path.sep)
+
+
+def extract_zip(fileobj, dest):
+    """Extract the zip archive in `fileobj` to the `dest` directory.
+
+    Unlike ZipFile.extractall, this restores the Unix mode bits stored in
+    each member's external attributes (http://bugs.python.org/issue15795),
+    and recreates symlinks. In particular, it's important that executable
+    test files in the archive remain executable, otherwise the tests won't
+    be run.
+
+    Archives are untrusted, so symlinks that are absolute or point outside
+    `dest` are left out, and UnsafeArchiveError is raised for any member
+    that would be written outside `dest` through a symlink.
+
+    """
+    dir_modes = []
+    archive = zipfile.ZipFile(fileobj)
+    try:
+        for info in archive.infolist():
+            # extract() strips absolute paths and '..' components, but
+            # follows any symlinks already extracted
+            if not is_within(member_path(info, dest), dest):
+                raise UnsafeArchiveError(
+                    'Archive member {} is outside {}'.format(
+                        info.filename, dest))
+            path = archive.extract(info, dest)
+            mode = info.external_attr >> 16
+            if not mode:
+                continue
+            if stat.S_ISLNK(mode):
+                with open(path, 'r') as f:
+                    target = f.read()
+                os.remove(path)
+                if os.path.isabs(target) or not is_within(
+                        os.path.join(os.path.dirname(path), target), dest):
+                    log.warning('Skipping symlink %s -> %s, which points '
+                                'outside the archive', info.filename, target)
+                    continue
+                os.symlink(target, path)
+            elif stat.S_ISDIR(mode) or info.filename.endswith('/'):
+                dir_modes.append((path, stat.S_IMODE(mode)))
+            else:
+                os.chmod(path, stat.S_IMODE(mode))
+    finally:
+        archive.close()
+
+    # Apply dir modes last, in case they'd prevent writing their contents
+    for path, mode in reversed(dir_modes):
+        os.chmod(path, mode)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .tree import copy_tree
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE_MB = 5 * 1024
+
+
+def get_cache_size():
+    """Max size in bytes of the fetch cache.
+
+    Read from CHARMGUARDIAN_CACHE_SIZE (in megabytes).
+
+    """
+    size = os.environ.get('CHARMGUARDIAN_CACHE_SIZE', DEFAULT_CACHE_SIZE_MB)
+    return int(size) * 1024 * 1024
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+class FetchCache(object):
+    """Persistent on-disk cache of fetched charm and bundle trees.
+
+    Each entry is a directory named by the hash of its key, holding the
+    cached ``tree`` and an ``entry.json`` describing it. The mtime of the
+    entry directory records when it was last used; once the cache grows
+    beyond `max_size` bytes the least recently used entries are evicted.
+
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = get_cache_size() if max_size is None else max_size
+        makedirs(self.path)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """Return the path of the cached tree for `key`, or None."""
+        entry = self._entry(key)
+        tree = os.path.join(entry, 'tree')
+        if not os.path.isdir(tree):
+            return None
+        try:
+            os.utime(entry, None)
+        except OSError:
+            return None
+        return tree
+
+    def put(self, key, src, **info):
+        """Store a copy of the tree at `src` under `key`.
+
+        Returns the path of the cached tree.
+
+        """
+        entry = self._entry(key)
+        tree = os.path.join(entry, 'tree')
+        if os.path.isdir(tree):
+            return tree
+
+        staging = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            copy_tree(src, os.path.join(staging, 'tree'))
+            info['size'] = tree_size(staging)
+            info['stored'] = time.time()
+            with open(os.path.join(staging, 'entry.json'), 'w') as f:
+                json.dump(info, f)
+            os.rename(staging, entry)
+        except (OSError, shutil.Error) as e:
+            # Most likely another process stored the same entry first
+            log.debug('Not caching %s: %s', src, e)
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+        return tree
+
+    def entries(self):
+        """Return (last_used, size, path) for each entry in the cache."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            entry = self._entry(name)
+            try:
+                with open(os.path.join(entry, 'entry.json'), 'r') as f:
+                    size = json.load(f)['size']
+                last_used = os.stat(entry).st_mtime
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            entries.append((last_used, size, entry))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, entry = entries.pop(0)
+            log.debug('Evicting %s from fetch cache', entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class JsonCache(object):
+    """Persistent on-disk cache of JSON documents.
+
+    Entries older than `ttl` seconds are treated as missing by `get`, but
+    remain available through `entry` (e.g. for revalidation) until they
+    are overwritten. A `ttl` of None means entries never expire.
+
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        makedirs(self.path)
+
+    def _file(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(key).hexdigest() + '.json')
+
+    def entry(self, key):
+        """Return the stored record for `key` regardless of its age.
+
+        The record is a dict with 'key', 'stored' and 'value' items, plus
+        any extra items passed to `put`.
+
+        """
+        try:
+            with open(self._file(key), 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return entry if entry.get('key') == key else None
+
+    def get(self, key, ttl=None):
+        entry = self.entry(key)
+        if entry is None:
+            return None
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and time.time() - entry['stored'] > ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value, **extra):
+        extra.update(key=key, value=value, stored=time.time())
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(extra, f)
+        os.rename(tmp, self._file(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
@@ -0,0 +1,116 @@
+"""
+Cached charmworld lookups.
+
+Lookups are memoized for the life of the process and, given a cache dir,
+stored on disk. Bundle ids that include a revision always refer to the
+same bundle, so they never expire. Other entries expire after
+CHARMGUARDIAN_CHARMWORLD_TTL seconds, or as soon as a search shows that
+a newer revision of the bundle has been published.
+
+"""
+import logging
+import os
+
+from charmworldlib.bundle import (
+    Bundle,
+    Bundles,
+)
+
+from .cache import JsonCache
+
+log = logging.getLogger(__name__)
+
+CHARMWORLD_TTL_SECS = 60 * 60
+
+_bundles = {}
+_searches = {}
+
+
+def get_ttl():
+    return int(os.environ.get(
+        'CHARMGUARDIAN_CHARMWORLD_TTL', CHARMWORLD_TTL_SECS))
+
+
+def get_cache(cache_dir, name):
+    if not cache_dir:
+        return None
+    return JsonCache(os.path.join(cache_dir, 'charmworld', name), get_ttl())
+
+
+def has_revision(bundle_id):
+    parts = bundle_id.split('/')
+    return len(parts) == 4 or (
+        len(parts) == 3 and not bundle_id.startswith('~'))
+
+
+def aliases(bundle_data):
+    """Return the unrevisioned ids that may refer to `bundle_data`."""
+    owner = bundle_data.get('owner', '').lstrip('~')
+    path = '{}/{}'.format(bundle_data['basket_name'], bundle_data['name'])
+    ids = ['~{}/{}'.format(owner, path)] if owner else []
+    if bundle_data.get('promulgated'):
+        ids.append(path)
+    return ids
+
+
+def get_bundle(bundle_id, cache_dir=None):
+    """Return the charmworldlib Bundle for `bundle_id`."""
+    if bundle_id in _bundles:
+        return _bundles[bundle_id]
+
+    cache = get_cache(cache_dir, 'bundles')
+    data = None
+    if cache:
+        data = cache.get(
+            bundle_id, ttl=float('inf') if has_revision(bundle_id) else None)
+    if data:
+        bundle = Bundle.from_bundledata(data)
+    else:
+        log.debug('Looking up bundle %s in charmworld', bundle_id)
+        bundle = Bundle(bundle_id)
+        if cache:
+            cache.put(bundle_id, bundle._raw)
+    _bundles[bundle_id] = bundle
+    return bundle
+
+
+def search_bundles(text, cache_dir=None):
+    """Return the charmworldlib Bundles found by searching for `text`.
+
+    Cached bundle lookups that the results show to be out of date are
+    invalidated.
+
+    """
+    if text in _searches:
+        return _searches[text]
+
+    cache = get_cache(cache_dir, 'search')
+    results = cache.get(text) if cache else None
+    if results is None:
+        log.debug('Searching charmworld for bundles matching %s', text)
+        results = [bundle._raw for bundle in Bundles().search(text)]
+        if cache:
+            cache.put(text, results)
+        invalidate_stale(results, cache_dir)
+
+    bundles = [Bundle.from_bundledata(data) for data in results]
+    _searches[text] = bundles
+    return bundles
+
+
+def invalidate_stale(results, cache_dir=None):
+    cache = get_cache(cache_dir, 'bundles')
+    for data in results:
+        for bundle_id in aliases(data):
+            bundle = _bundles.get(bundle_id)
+            cached = bundle._raw if bundle else None
+            if cache and not cached:
+                entry = cache.entry(bundle_id)
+                cached = entry['value'] if entry else None
+            if not cached:
+                continue
+            if cached.get('basket_revision') != data.get('basket_revision'):
+                log.debug('Invalidating stale bundle %s', bundle_id)
+                _bundles.pop(bundle_id, None)
+                if cache:
+                    cache.delete(bundle_id)
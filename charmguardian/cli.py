@@ -4,7 +4,61 @@ charmguardian is a test-runner for Juju charms and bundles.
 Use CHARM_TEST_ENVS and BUNDLE_TEST_ENVS to control which Juju environments
 are used for tests (default is 'local').
 
-Test results are written to stdout as json.
+Tests in all environments, including those of bundles that use a charm,
+share one job queue. Only one test at a time runs in each environment, as
+bundletester destroys the environment when it's done. Use
+CHARMGUARDIAN_ENV_LIMITS to allow more in environments that can take them,
+e.g. CHARMGUARDIAN_ENV_LIMITS=amazon=6, and CHARMGUARDIAN_MAX_JOBS to cap
+the number running at once across all environments (default: no cap).
+
+Each test runs in a worker process by default, with as many workers as
+the environments can run tests at once. Set CHARMGUARDIAN_EXECUTOR=thread
+to run them in threads of one process instead, which is lighter when there
+are many.
+
+With --cache-dir, environments listed in CHARMGUARDIAN_WARM_ENVS are kept
+bootstrapped between tests and runs, and only have their services and
+machines removed after each test. Each is destroyed and bootstrapped
+afresh after CHARMGUARDIAN_ENV_MAX_USES tests (default 10) or when it fails
+a health check. A warm environment runs one test at a time.
+
+A test is killed, with any processes it started, if it runs for more
+than CHARMGUARDIAN_JOB_TIMEOUT seconds (default 10800), or goes without
+output for CHARMGUARDIAN_IDLE_TIMEOUT seconds (default: no limit); 0 turns
+either limit off. Each test record notes the wall-clock and CPU time, max
+RSS and peak disk usage of its test under "resources". Disk usage is the
+apparent size of the files in the test's .deployer-branches/<env> dir,
+sampled every 10 seconds; symlinks count as the links themselves.
+
+Unless --shallow is used, a charm is also tested in each promulgated bundle
+that contains it. Up to CHARMGUARDIAN_BUNDLE_JOBS (default 4) of these
+bundles are tested at once, each in its own workspace dir.
+
+Use --cache-dir to keep fetched charms and bundles between runs. The cache
+is limited to CHARMGUARDIAN_CACHE_SIZE megabytes (default 5120); the least
+recently used entries are evicted first. Charm Store metadata is cached
+there too, for CHARMGUARDIAN_STORE_TTL seconds (default 900), as are
+charmworld bundle lookups, for CHARMGUARDIAN_CHARMWORLD_TTL seconds (default
+3600). Passing test results are cached for CHARMGUARDIAN_RESULT_TTL seconds
+(default 604800), and reused by tests of identical content in the same
+environment with the same bundletester version.
+
+HTTP requests share a pool of keep-alive connections and are retried on
+failure. Use CHARMGUARDIAN_HTTP_POOL_SIZE (default 10) and
+CHARMGUARDIAN_HTTP_RETRIES (default 3) to tune them, and
+CHARMGUARDIAN_HTTP_TIMEOUTS to set per-host timeouts in seconds, e.g.
+CHARMGUARDIAN_HTTP_TIMEOUTS=api.launchpad.net=60,store.juju.ubuntu.com=30
+
+For merge proposals and revision ranges (BASE..REV), only the tests that
+the changed files can affect are run: `charm proof` alone if only docs
+changed, the charm's own tests if only its tests changed, and everything
+otherwise. The decision is recorded under "impact" in the results. Use
+--no-impact to always run everything.
+
+Test results are written to stdout as json. Use --events FILE to also
+follow a run as it proceeds: an event is appended to FILE, as a line of
+json, when each test is queued, starts, and finishes, and when a charm or
+bundle has been fetched. See `charmguardian.events`.
 
 
 EXAMPLES
@@ -37,6 +91,10 @@ charmguardian gh:charms/apache2 52e73d
 charmguardian github:charms/apache2 52e73d
 charmguardian https://github.com/charms/apache2 52e73d
 
+# Test Github repo at a revision, running only the tests affected by the
+# changes since another revision
+charmguardian gh:charms/apache2 1a2b3c..52e73d
+
 # Test Bitbucket repo at specific revision
 # (For Bitbucket, repos that don't end in '.git' are assumed to be Mercurial.)
 charmguardian bb:battlemidget/juju-apache-gunicorn-django.git
@@ -55,10 +113,14 @@ import os
 import signal
 import sys
 
+from . import events
+from .download import http_stats
 from .formatters import fmt
 from .testers import test
 from .util import timestamp
 
+log = logging.getLogger(__name__)
+
 
 class validate_dir(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -70,6 +132,19 @@ class validate_dir(argparse.Action):
         setattr(namespace, self.dest, path)
 
 
+class make_dir(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        path = os.path.abspath(os.path.expanduser(values))
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as e:
+            sys.stderr.write(
+                "Invalid cache directory: {}: {}\n".format(values, e))
+            sys.exit(2)
+        setattr(namespace, self.dest, path)
+
+
 def get_parser():
     description, epilog = __doc__.split('---')
 
@@ -85,7 +160,20 @@ def get_parser():
     )
     parser.add_argument(
         'revision', nargs='?',
-        help='Revision to test. Defaults to HEAD of branch implied by URL.',
+        help='Revision to test. Defaults to HEAD of branch implied by URL. '
+             'May be a range, BASE..REV, to test REV as a change to BASE.',
+    )
+    parser.add_argument(
+        '--all-deployments', action='store_true',
+        help='Test every deployment in a bundle, in parallel. By default '
+             'one deployment is tested per run: the least recently tested '
+             'one if --cache-dir is given, otherwise a random one.',
+    )
+    parser.add_argument(
+        '--cache-dir', action=make_dir, default=None,
+        help='Directory in which to cache fetched charms and bundles across '
+             'runs. Created if it does not exist. If not specified, nothing '
+             'is cached.',
     )
     parser.add_argument(
         '--constraints',
@@ -95,6 +183,26 @@ def get_parser():
         '--debug', action='store_true',
         help='Increase output verbosity and skip cleanup of temp files.',
     )
+    parser.add_argument(
+        '--events', metavar='FILE',
+        help='Append progress events to FILE, one json object per line.',
+    )
+    parser.add_argument(
+        '--fail-fast', action='store_true',
+        help='Stop at the first failing test. Tests that have not finished '
+             'are cancelled and reported as skipped.',
+    )
+    parser.add_argument(
+        '--full-clone', action='store_true',
+        help='When a revision is given for a git repo, clone the full '
+             'history. By default only the given revision is fetched, '
+             'falling back to a full clone if the server refuses.',
+    )
+    parser.add_argument(
+        '--no-impact', action='store_true',
+        help='Run all tests for a merge proposal or revision range, even '
+             'if the changed files show that fewer would do.',
+    )
     parser.add_argument(
         '--shallow', action='store_true',
         help='When testing a charm, test the charm only; do not test bundles '
@@ -144,13 +252,21 @@ def main():
 
     try:
         install_signal_handlers(args.url)
+        if args.events:
+            events.open_stream(args.events)
         result = test(
             args.url,
             revision=args.revision,
             shallow=args.shallow,
             workspace=args.workspace,
             constraints=args.constraints,
+            cache_dir=args.cache_dir,
+            full_clone=args.full_clone,
+            fail_fast=args.fail_fast,
+            impact=not args.no_impact,
+            all_deployments=args.all_deployments,
         )
+        log.debug('HTTP connection stats: %s', http_stats())
         result = fmt(args.url, result)
         print(json.dumps(result, indent=4))
         sys.stderr.write(
@@ -159,6 +275,8 @@ def main():
     except Exception as e:
         sys.stderr.write('{}\n'.format(e))
         sys.exit(1)
+    finally:
+        events.close_stream()
 
 
 if __name__ == '__main__':
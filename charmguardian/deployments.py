@@ -0,0 +1,55 @@
+"""
+Chooses which of a bundle's deployments to test.
+
+Testing every deployment of every bundle on every run is expensive, so
+by default one deployment is tested per run. Given a cache dir, the time
+each deployment was last tested is kept there, per bundle, and the
+least recently tested deployment is chosen, so that runs rotate through
+all of them. Without history the choice is random.
+
+"""
+import logging
+import os
+import random
+import time
+
+from .cache import JsonCache
+
+log = logging.getLogger(__name__)
+
+
+class DeploymentHistory(object):
+    """When each deployment of each bundle was last tested."""
+    def __init__(self, cache_dir):
+        self.cache = JsonCache(os.path.join(cache_dir, 'deployments'))
+
+    def last_tested(self, bundle):
+        """Return a dict of deployment: time last tested, for `bundle`."""
+        return self.cache.get(bundle) or {}
+
+    def record(self, bundle, deployments):
+        tested = self.last_tested(bundle)
+        now = time.time()
+        tested.update((deployment, now) for deployment in deployments)
+        self.cache.put(bundle, tested)
+
+
+def choose_deployments(deployments, history=None, bundle=None):
+    """Return a list holding the deployment to test, out of `deployments`.
+
+    If `history` and the `bundle` id are given, the least recently tested
+    deployment is chosen, at random among those never tested or tested
+    equally long ago.
+
+    """
+    deployments = sorted(deployments)
+    if not deployments:
+        return []
+    if history is None or bundle is None:
+        return [random.choice(deployments)]
+    tested = history.last_tested(bundle)
+    oldest = min(tested.get(d, 0) for d in deployments)
+    candidates = [d for d in deployments if tested.get(d, 0) == oldest]
+    log.debug('Least recently tested deployments of %s: %s',
+              bundle, ', '.join(candidates))
+    return [random.choice(candidates)]
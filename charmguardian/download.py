@@ -0,0 +1,234 @@
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urlparse
+
+import requests
+from requests.packages.urllib3.exceptions import HTTPError
+
+log = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT_SECS = 45
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF_SECS = 0.5
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+
+_session = None
+_retries = 0
+_lock = threading.Lock()
+
+
+def get_session():
+    """Return the HTTP session shared by all fetchers in this process.
+
+    Connections are kept alive and pooled per host. The pool size is read
+    from CHARMGUARDIAN_HTTP_POOL_SIZE.
+
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            size = int(os.environ.get(
+                'CHARMGUARDIAN_HTTP_POOL_SIZE', HTTP_POOL_SIZE))
+            session = requests.Session()
+            for prefix in ('http://', 'https://'):
+                session.mount(prefix, requests.adapters.HTTPAdapter(
+                    pool_connections=size, pool_maxsize=size))
+            _session = session
+        return _session
+
+
+def get_timeouts():
+    """Return a dict of per-host request timeouts, in seconds.
+
+    Read from CHARMGUARDIAN_HTTP_TIMEOUTS, e.g.
+    'api.launchpad.net=60,store.juju.ubuntu.com=30'.
+
+    """
+    timeouts = {}
+    for item in os.environ.get('CHARMGUARDIAN_HTTP_TIMEOUTS', '').split(','):
+        if '=' in item:
+            host, secs = item.split('=', 1)
+            timeouts[host.strip()] = float(secs)
+    return timeouts
+
+
+def get(url, **kw):
+    """GET `url` using the shared session.
+
+    Connection errors, timeouts and 5xx responses are retried with
+    exponential backoff.
+
+    """
+    global _retries
+    if 'timeout' not in kw:
+        host = urlparse.urlparse(url).hostname
+        kw['timeout'] = get_timeouts().get(host, REQUEST_TIMEOUT_SECS)
+
+    retries = int(os.environ.get('CHARMGUARDIAN_HTTP_RETRIES', HTTP_RETRIES))
+    for attempt in range(retries + 1):
+        try:
+            r = get_session().get(url, **kw)
+            if r.status_code not in HTTP_RETRY_STATUSES:
+                return r
+            error = 'HTTP {}'.format(r.status_code)
+            if attempt < retries:
+                # Give a streamed response's connection back to the pool
+                r.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            error = e
+        if attempt == retries:
+            return r
+        delay = HTTP_RETRY_BACKOFF_SECS * 2 ** attempt
+        log.debug('GET %s failed (%s), retrying in %ss', url, error, delay)
+        with _lock:
+            _retries += 1
+        time.sleep(delay)
+
+
+def http_stats():
+    """Return request and connection counts for the shared session.
+
+    Only requests made in this process are counted. Fetches run here, but
+    anything a test job requests from a worker process uses that
+    worker's own session, and isn't included.
+
+    """
+    stats = {'requests': 0, 'connections': 0, 'retries': _retries}
+    adapters = _session.adapters.values() if _session else []
+    for adapter in set(adapters):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = stats['requests'] - stats['connections']
+    return stats
+
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_RESUMES = 5
+
+
+class DownloadError(Exception):
+    pass
+
+
+def content_total(r):
+    """Return the full size of the entity in response `r`, if known.
+
+    A 206 response's Content-Length only counts the part sent, so its
+    size is taken from Content-Range instead.
+
+    """
+    if r.status_code == 206:
+        total = r.headers.get('content-range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = r.headers.get('content-length')
+    return int(length) if length else None
+
+
+def download(url, f, sha256=None):
+    """Stream the content at `url` into the file object `f`.
+
+    Nothing is flushed until the caller closes `f`. The content is asked
+    for without any content-coding, so that if the connection drops part
+    way through, the download can resume from the last byte received
+    using an HTTP Range request. (If the server encodes it anyway, the
+    download restarts instead.) The size received is checked against
+    Content-Length and, if given, the content against the `sha256` hex
+    digest.
+
+    Returns a dict of stats about the transfer.
+
+    """
+    started = time.time()
+    digest = hashlib.sha256()
+    received, expected, resumes = 0, None, 0
+
+    while True:
+        # Range offsets count bytes of the encoded entity, so only ask for
+        # an unencoded one
+        headers = {'Accept-Encoding': 'identity'}
+        if received:
+            headers['Range'] = 'bytes={}-'.format(received)
+        try:
+            r = get(url, stream=True, headers=headers)
+        except requests.RequestException as e:
+            raise DownloadError('Download of {} failed: {}'.format(url, e))
+        if r.status_code >= 400:
+            r.close()
+            raise DownloadError('Download of {} failed: HTTP {}'.format(
+                url, r.status_code))
+        if received and r.status_code != 206:
+            log.debug('%s does not support resume, restarting', url)
+            f.seek(0)
+            f.truncate()
+            digest = hashlib.sha256()
+            received, expected = 0, None
+        encoded = r.headers.get(
+            'content-encoding', 'identity').lower() != 'identity'
+        if expected is None and not encoded:
+            expected = content_total(r)
+
+        try:
+            while True:
+                chunk = r.raw.read(DOWNLOAD_CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                received += len(chunk)
+        except (HTTPError, httplib.HTTPException, socket.error,
+                requests.RequestException) as e:
+            resumes += 1
+            if resumes > DOWNLOAD_RESUMES:
+                raise DownloadError(
+                    'Download of {} failed: {}'.format(url, e))
+            if encoded:
+                # The decoded size received says nothing about where to
+                # resume the encoded entity
+                log.debug('Download of %s interrupted (%s), restarting',
+                          url, e)
+                f.seek(0)
+                f.truncate()
+                digest = hashlib.sha256()
+                received = 0
+            else:
+                log.debug('Download of %s interrupted at %s bytes (%s), '
+                          'resuming', url, received, e)
+            continue
+        finally:
+            r.close()
+
+        if expected is not None and received < expected:
+            resumes += 1
+            if resumes > DOWNLOAD_RESUMES:
+                raise DownloadError('Download of {} truncated at {} of {} '
+                                    'bytes'.format(url, received, expected))
+            continue
+        break
+
+    if expected is not None and received != expected:
+        raise DownloadError('Download of {} is {} bytes, expected {}'.format(
+            url, received, expected))
+    if sha256 and digest.hexdigest() != sha256:
+        raise DownloadError('Download of {} has sha256 {}, expected {}'.format(
+            url, digest.hexdigest(), sha256))
+
+    seconds = time.time() - started
+    return {
+        'url': url,
+        'bytes': received,
+        'seconds': round(seconds, 3),
+        'bytes_per_sec': int(received / seconds) if seconds else None,
+        'resumes': resumes,
+        'sha256': digest.hexdigest(),
+    }
@@ -0,0 +1,220 @@
+"""
+Keeps bootstrapped Juju environments warm across tests and runs.
+
+bundletester bootstraps an environment that isn't bootstrapped, and then
+destroys it when it's done. Bootstrapping is often the slowest part of a
+test, so environments listed in CHARMGUARDIAN_WARM_ENVS (e.g.
+'local,amazon') are instead leased to tests from a pool:
+
+- before a test, the environment is bootstrapped unless it already is
+  and passes a health check;
+- after a test, its services and machines are removed, but the
+  environment itself is left running for the next test, in this run or
+  a later one;
+- after CHARMGUARDIAN_ENV_MAX_USES tests (default 10), or if a reset
+  fails, the environment is destroyed, to be bootstrapped afresh.
+
+A warm environment runs one test at a time. Lease state is kept in the
+cache dir, so the pool is only used with --cache-dir.
+
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import shlex
+import subprocess
+import time
+
+from .cache import makedirs
+
+log = logging.getLogger(__name__)
+
+ENV_MAX_USES = 10
+
+
+def get_warm_envs():
+    envs = os.environ.get('CHARMGUARDIAN_WARM_ENVS', '').split(',')
+    return [env.strip() for env in envs if env.strip()]
+
+
+def get_max_uses():
+    return int(os.environ.get('CHARMGUARDIAN_ENV_MAX_USES', ENV_MAX_USES))
+
+
+def get_env_pool(cache_dir):
+    """Return the EnvPool for `cache_dir`, or None if no envs are warm."""
+    envs = get_warm_envs()
+    if not (cache_dir and envs):
+        return None
+    return EnvPool(os.path.join(cache_dir, 'envs'), envs)
+
+
+class EnvError(Exception):
+    pass
+
+
+class JujuProvider(object):
+    """Manages environments with the juju and juju-deployer commands."""
+    def bootstrap(self, env, constraints=None):
+        cmd = 'juju bootstrap -e {}'.format(env)
+        if constraints:
+            cmd = '{} --constraints "{}"'.format(cmd, constraints)
+        run(cmd)
+
+    def is_healthy(self, env):
+        try:
+            status = json.loads(run('juju status -e {} --format json'.format(
+                env)))
+        except (EnvError, ValueError):
+            return False
+        machine = status.get('machines', {}).get('0', {})
+        return machine.get('agent-state') == 'started'
+
+    def reset(self, env):
+        """Remove all services and machines except the bootstrap node."""
+        run('juju-deployer -e {} -T -W'.format(env))
+
+    def destroy(self, env):
+        run('juju destroy-environment -y --force {}'.format(env))
+
+
+class FakeProvider(object):
+    """Stands in for JujuProvider in tests; no cloud required.
+
+    State is kept in `path`, a JSON file, so that it is shared by worker
+    processes. Set `fail` to a list of method names that should fail.
+
+    """
+    def __init__(self, path, fail=()):
+        self.path = path
+        self.fail = list(fail)
+
+    def state(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'envs': {}, 'calls': []}
+
+    def _call(self, method, env, bootstrapped=None):
+        state = self.state()
+        state['calls'].append([method, env])
+        if bootstrapped is not None:
+            state['envs'][env] = bootstrapped
+        with open(self.path, 'w') as f:
+            json.dump(state, f)
+        if method in self.fail:
+            raise EnvError('{} of {} failed'.format(method, env))
+
+    def bootstrap(self, env, constraints=None):
+        self._call('bootstrap', env, True)
+
+    def is_healthy(self, env):
+        return (self.state()['envs'].get(env, False) and
+                'is_healthy' not in self.fail)
+
+    def reset(self, env):
+        self._call('reset', env)
+
+    def destroy(self, env):
+        self._call('destroy', env, False)
+
+
+class EnvPool(object):
+    """Leases warm environments to tests.
+
+    Each env has a lock file and a JSON state file in `path`, so leases
+    are exclusive across the worker processes of a run, and across runs.
+
+    """
+    def __init__(self, path, envs, provider=None, max_uses=None):
+        self.path = path
+        self.envs = envs
+        self.provider = provider or JujuProvider()
+        self.max_uses = max_uses or get_max_uses()
+
+    def state_file(self, env):
+        return os.path.join(self.path, env + '.json')
+
+    def read_state(self, env):
+        try:
+            with open(self.state_file(env)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'uses': 0, 'bootstrapped': None}
+
+    def write_state(self, env, state):
+        tmp = self.state_file(env) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.state_file(env))
+
+    def recycle(self, env, reason):
+        log.debug('Recycling env %s: %s', env, reason)
+        try:
+            self.provider.destroy(env)
+        except EnvError as e:
+            log.debug('Destroying env %s failed: %s', env, e)
+        return {'uses': 0, 'bootstrapped': None}
+
+    @contextmanager
+    def lease(self, env, constraints=None):
+        """Hold `env`, bootstrapped and empty, for the duration of a test.
+
+        Yields the env's state: how many tests have used it since it was
+        bootstrapped, and when that was. Yields None, without leasing the
+        env, if it can't be bootstrapped.
+
+        """
+        makedirs(self.path)
+        with open(os.path.join(self.path, env + '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.read_state(env)
+            if state['uses'] >= self.max_uses:
+                state = self.recycle(env, '{} uses'.format(state['uses']))
+            if state['bootstrapped'] and not self.provider.is_healthy(env):
+                state = self.recycle(env, 'health check failed')
+            if not state['bootstrapped']:
+                log.debug('Bootstrapping env %s', env)
+                try:
+                    self.provider.bootstrap(env, constraints)
+                except EnvError as e:
+                    # Leave it to the test to bootstrap, and destroy, the
+                    # env as if it weren't pooled
+                    log.debug('Bootstrapping env %s failed: %s', env, e)
+                    self.write_state(env, state)
+                    yield None
+                    return
+                state['bootstrapped'] = time.time()
+            self.write_state(env, state)
+            try:
+                yield dict(state)
+            finally:
+                state['uses'] += 1
+                try:
+                    self.provider.reset(env)
+                except EnvError as e:
+                    state = self.recycle(env, 'reset failed: {}'.format(e))
+                self.write_state(env, state)
+
+
+def run_leased(pool, env, func, *args, **kw):
+    """Call func(*args, **kw) holding a lease on `env` from `pool`."""
+    with pool.lease(env, kw.get('constraints')) as state:
+        if state:
+            log.debug('Leased env %s (%s previous uses)', env, state['uses'])
+        return func(*args, **kw)
+
+
+def run(cmd):
+    p = subprocess.Popen(
+        shlex.split(cmd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        raise EnvError('{} failed: {}'.format(cmd, out))
+    return out
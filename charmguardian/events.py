@@ -0,0 +1,53 @@
+"""
+Progress events, written as newline-delimited JSON while a run proceeds.
+
+Events are only written once a stream has been opened with `open_stream`
+(the --events option). Each is a JSON object on its own line, with the
+'event' type and the 'time' it happened, plus:
+
+    job-queued      job, env, url, deployment: a test has been queued
+    env-started     job, env: the test has started running
+    fetch-done      url, revision (or error): a charm or bundle is fetched
+    test-finished   job, env, url, deployment, record: one bundletester
+                    test record, as each job finishes
+    job-finished    job, env, url, deployment, result, cached: a test
+                    has finished, passed or failed, or was skipped
+
+Jobs are numbered within a run; a job's events share its number.
+
+"""
+from datetime import datetime
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+_stream = None
+_lock = threading.Lock()
+
+
+def open_stream(path):
+    """Write events to the file at `path`, appending if it exists."""
+    global _stream
+    _stream = open(path, 'a', 1)
+
+
+def close_stream():
+    global _stream
+    if _stream:
+        _stream.close()
+    _stream = None
+
+
+def emit(event, **fields):
+    if _stream is None:
+        return
+    fields.update(event=event, time=datetime.utcnow().isoformat() + 'Z')
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    with _lock:
+        try:
+            _stream.write(line)
+            _stream.flush()
+        except (IOError, ValueError) as e:
+            log.debug('Could not write %s event: %s', event, e)
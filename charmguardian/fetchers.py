@@ -1,3 +1,7 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
 import logging
 import os
 import re
@@ -6,34 +10,167 @@ import shutil
 import subprocess
 import tempfile
 
-import requests
-
-from charmworldlib.bundle import Bundle
+from .archive import (
+    UnsafeArchiveError,
+    extract_zip,
+)
+from .cache import (
+    FetchCache,
+    JsonCache,
+    makedirs,
+)
+from .charmworld import get_bundle
+from .download import (
+    DownloadError,
+    download,
+    get,
+)
+from .tree import copy_tree
 
 log = logging.getLogger(__name__)
 
-REQUEST_TIMEOUT_SECS = 45
-
-
-def get(*args, **kw):
-    if 'timeout' not in kw:
-        kw['timeout'] = REQUEST_TIMEOUT_SECS
-
-    return requests.get(*args, **kw)
-
 
 class Fetcher(object):
+    cache_dir = None
+    full_clone = False
+    download_stats = None
+    base_revision = None
+
     def __init__(self, url, revision, **kw):
         self.url = url
         self.revision = revision
         for k, v in kw.items():
             setattr(self, k, v)
+        if revision and '..' in revision:
+            # A range BASE..REV: REV is tested, BASE is what it changes
+            self.base_revision, self.revision = revision.split('..', 1)
 
     @classmethod
     def can_fetch(cls, url):
         match = cls.MATCH.search(url)
         return match.groupdict() if match else {}
 
+    def cache_key(self):
+        """Return a tuple identifying the tree this fetcher will produce.
+
+        The tuple is (fetcher type, normalized url, resolved revision).
+        Returns None if the tree can't be identified without fetching it,
+        in which case it won't be cached.
+
+        """
+        revision = self.resolve_revision()
+        if not revision:
+            return None
+        return (type(self).__name__, self.canonical_url(), revision)
+
+    def canonical_url(self):
+        return self.url
+
+    def resolve_revision(self):
+        """Return an immutable identifier for the revision to be fetched."""
+        return self.revision
+
+    def previous_result(self, options=None):
+        """Return the result of an earlier run that still applies, if any.
+
+        `options` are the test options and environments of this run; a
+        result only applies to a run with the same ones. If a result is
+        returned, the fetch and test are skipped.
+
+        """
+        return None
+
+    def record_result(self, result, options=None):
+        pass
+
+    def changed_files(self, dir_):
+        """Return the paths changed in the tree at `dir_` since the base
+        revision, or None if they can't be determined.
+
+        """
+        if not self.base_revision:
+            return None
+        dirlist = os.listdir(dir_)
+        try:
+            if '.git' in dirlist:
+                return self.git_changed_files(dir_)
+            elif '.bzr' in dirlist:
+                return parse_bzr_status(check_output(
+                    'bzr status --short -r {}'.format(self.base_revision),
+                    cwd=dir_))
+            elif '.hg' in dirlist:
+                return check_output(
+                    'hg status -n --rev {}'.format(self.base_revision),
+                    cwd=dir_).splitlines()
+        except FetchError as e:
+            log.debug('Could not list changed files: %s', e)
+        return None
+
+    def git_changed_files(self, dir_):
+        base = self.base_revision
+        try:
+            check_output('git cat-file -e {}^{{commit}}'.format(base),
+                         cwd=dir_)
+        except FetchError:
+            # Shallow fetches have only the tested commit
+            git('fetch -q --depth 1 origin {}'.format(base), cwd=dir_)
+            base = 'FETCH_HEAD'
+        return check_output(
+            'git diff --name-only {} HEAD'.format(base),
+            cwd=dir_).splitlines()
+
+    @property
+    def mirrors(self):
+        if not self.cache_dir:
+            return None
+        return MirrorPool(os.path.join(self.cache_dir, 'mirrors'))
+
+    def bzr_branch(self, url, dir_):
+        if self.mirrors:
+            return self.mirrors.bzr(url, dir_, self.revision)
+        cmd = 'branch --use-existing-dir {} {}'.format(url, dir_)
+        if self.revision:
+            cmd = '{} -r {}'.format(cmd, self.revision)
+        bzr(cmd)
+        return dir_
+
+    def git_clone(self, url, dir_):
+        if self.mirrors:
+            return self.mirrors.git(url, dir_, self.revision)
+        if self.revision and not self.full_clone:
+            try:
+                return self.git_fetch_revision(url, dir_)
+            except FetchError as e:
+                log.debug('Shallow fetch of %s failed, cloning: %s', url, e)
+                shutil.rmtree(dir_)
+                os.mkdir(dir_)
+        git('clone {} {}'.format(url, dir_))
+        if self.revision:
+            git('checkout {}'.format(self.revision), cwd=dir_)
+        return dir_
+
+    def git_fetch_revision(self, url, dir_):
+        """Fetch only the commit at self.revision, with no history.
+
+        Fails if the server won't serve the revision directly, e.g. when
+        it's an abbreviated sha.
+
+        """
+        git('init -q', cwd=dir_)
+        git('remote add origin {}'.format(url), cwd=dir_)
+        git('fetch -q --depth 1 origin {}'.format(self.revision), cwd=dir_)
+        git('checkout -q FETCH_HEAD', cwd=dir_)
+        return dir_
+
+    def hg_clone(self, url, dir_):
+        if self.mirrors:
+            return self.mirrors.hg(url, dir_, self.revision)
+        cmd = 'clone {} {}'.format(url, dir_)
+        if self.revision:
+            cmd = '{} -u {}'.format(cmd, self.revision)
+        hg(cmd)
+        return dir_
+
     def get_revision(self, dir_):
         dirlist = os.listdir(dir_)
         if '.bzr' in dirlist:
@@ -58,30 +195,128 @@ class BzrFetcher(Fetcher):
         matchdict = super(BzrFetcher, cls).can_fetch(url)
         return matchdict if '/+merge/' not in matchdict.get('repo', '') else {}
 
+    def canonical_url(self):
+        return 'lp:' + self.repo.rstrip('/')
+
+    def resolve_revision(self):
+        cmd = 'revision-info -d {}'.format(self.canonical_url())
+        if self.revision:
+            cmd = '{} -r {}'.format(cmd, self.revision)
+        return check_output('bzr ' + cmd).split()[1]
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
         url = 'lp:' + self.repo
-        cmd = 'branch --use-existing-dir {} {}'.format(url, dir_)
-        if self.revision:
-            cmd = '{} -r {}'.format(cmd, self.revision)
-        bzr(cmd)
-        return dir_
+        return self.bzr_branch(url, dir_)
 
 
 class BzrMergeProposalFetcher(BzrFetcher):
+    API_BASE = 'https://api.launchpad.net/devel/'
+
+    _merge_data = None
+    _tips = None
+
     @classmethod
     def can_fetch(cls, url):
         matchdict = super(BzrFetcher, cls).can_fetch(url)
         return matchdict if '/+merge/' in matchdict.get('repo', '') else {}
 
+    def resolve_revision(self):
+        # The merged tree doesn't exist until we've built it
+        return None
+
+    @property
+    def results(self):
+        if not self.cache_dir:
+            return None
+        return JsonCache(os.path.join(self.cache_dir, 'merge-proposals'))
+
+    def get_json(self, url):
+        """GET a Launchpad API resource.
+
+        With a cache dir, the last response for each url is kept along with
+        its ETag, and revalidated with If-None-Match instead of being
+        downloaded again.
+
+        """
+        cache, entry, headers = None, None, {}
+        if self.cache_dir:
+            cache = JsonCache(os.path.join(self.cache_dir, 'launchpad'))
+            entry = cache.entry(url)
+            if entry and entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+        r = get(url, headers=headers)
+        if r.status_code == 304 and entry:
+            log.debug('%s not modified', url)
+            return entry['value']
+        data = r.json()
+        if cache and r.headers.get('etag'):
+            cache.put(url, data, etag=r.headers['etag'])
+        return data
+
+    @property
+    def merge_data(self):
+        if self._merge_data is None:
+            self._merge_data = self.get_json(self.API_BASE + self.repo)
+        return self._merge_data
+
+    def branch_url(self, key):
+        return 'lp:' + self.merge_data[key][len(self.API_BASE):]
+
+    def tips(self):
+        """Return the last scanned revision ids of the target and source."""
+        if self._tips is None:
+            self._tips = [
+                self.get_json(self.merge_data[key]).get('last_scanned_id')
+                for key in ('target_branch_link', 'source_branch_link')]
+        return self._tips
+
+    def result_key(self, options):
+        return '{}\0{}'.format(
+            self.url, json.dumps(options or {}, sort_keys=True, default=str))
+
+    def previous_result(self, options=None):
+        results = self.results
+        entry = results.get(self.result_key(options)) if results else None
+        if not entry or None in self.tips() or entry['tips'] != self.tips():
+            return None
+        log.debug('Target and source of %s unchanged since last run',
+                  self.url)
+        return dict(entry['result'], cached=True)
+
+    def record_result(self, result, options=None):
+        """Keep `result` for reruns with the same tips and `options`.
+
+        As with the result cache, only passing results with no skipped
+        tests are kept; failures may be flaky, and are worth retrying.
+
+        """
+        results = self.results
+        if not results or None in self.tips():
+            return
+        if result.get('result') != 'pass' or has_skipped(
+                result.get('tests')):
+            return
+        results.put(self.result_key(options),
+                    {'tips': self.tips(), 'result': result})
+
+    def changed_files(self, dir_):
+        try:
+            # The merge commit, against the target branch
+            return parse_bzr_status(check_output(
+                'bzr status --short --change -1', cwd=dir_))
+        except FetchError as e:
+            log.debug('Could not list changed files: %s', e)
+            return None
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
-        api_base = 'https://api.launchpad.net/devel/'
-        url = api_base + self.repo
-        merge_data = get(url).json()
-        target = 'lp:' + merge_data['target_branch_link'][len(api_base):]
-        source = 'lp:' + merge_data['source_branch_link'][len(api_base):]
-        bzr('branch --use-existing-dir {} {}'.format(target, dir_))
+        target = self.branch_url('target_branch_link')
+        source = self.branch_url('source_branch_link')
+        if self.mirrors:
+            self.mirrors.bzr(target, dir_)
+        else:
+            bzr('branch --use-existing-dir {} {}'.format(target, dir_))
         bzr('merge {}'.format(source), cwd=dir_)
         bzr('commit --unchanged -m "Merge commit"', cwd=dir_)
         return dir_
@@ -92,13 +327,19 @@ class GithubFetcher(Fetcher):
     ^(gh:|github:|https?://(www\.)?github.com/)(?P<repo>.*)$
     """, re.VERBOSE)
 
+    def canonical_url(self):
+        repo = self.repo.rstrip('/')
+        if repo.endswith('.git'):
+            repo = repo[:-len('.git')]
+        return 'https://github.com/' + repo
+
+    def resolve_revision(self):
+        return resolve_git_revision(self.canonical_url(), self.revision)
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
         url = 'https://github.com/' + self.repo
-        git('clone {} {}'.format(url, dir_))
-        if self.revision:
-            git('checkout {}'.format(self.revision), cwd=dir_)
-        return dir_
+        return self.git_clone(url, dir_)
 
 
 class BitbucketFetcher(Fetcher):
@@ -106,6 +347,18 @@ class BitbucketFetcher(Fetcher):
     ^(bb:|bitbucket:|https?://(www\.)?bitbucket.org/)(?P<repo>.*)$
     """, re.VERBOSE)
 
+    def canonical_url(self):
+        return 'https://bitbucket.org/' + self.repo.rstrip('/')
+
+    def resolve_revision(self):
+        url = self.canonical_url()
+        if url.endswith('.git'):
+            return resolve_git_revision(url, self.revision)
+        cmd = 'identify --debug -i {}'.format(url)
+        if self.revision:
+            cmd = '{} -r {}'.format(cmd, self.revision)
+        return check_output('hg ' + cmd).strip()
+
     def fetch(self, dir_):
         dir_ = tempfile.mkdtemp(dir=dir_)
         url = 'https://bitbucket.org/' + self.repo
@@ -114,17 +367,10 @@ class BitbucketFetcher(Fetcher):
         return self._fetch_hg(url, dir_)
 
     def _fetch_git(self, url, dir_):
-        git('clone {} {}'.format(url, dir_))
-        if self.revision:
-            git('checkout {}'.format(self.revision), cwd=dir_)
-        return dir_
+        return self.git_clone(url, dir_)
 
     def _fetch_hg(self, url, dir_):
-        cmd = 'clone {} {}'.format(url, dir_)
-        if self.revision:
-            cmd = '{} -u {}'.format(cmd, self.revision)
-        hg(cmd)
-        return dir_
+        return self.hg_clone(url, dir_)
 
 
 class LocalFetcher(Fetcher):
@@ -132,36 +378,66 @@ class LocalFetcher(Fetcher):
     ^local:(?P<path>.*)$
     """, re.VERBOSE)
 
+    def resolve_revision(self):
+        # Local dirs change under our feet, so never cache them
+        return None
+
     def fetch(self, dir_):
         src = os.path.abspath(
             os.path.join(os.getcwd(), os.path.expanduser(self.path)))
         dst = os.path.join(dir_, os.path.basename(src.rstrip('/')))
-        shutil.copytree(src, dst, symlinks=True)
+        copy_tree(src, dst)
         return dst
 
 
+STORE_TTL_SECS = 15 * 60
+STORE_REVISION = re.compile(r'-\d+$')
+
+
 class StoreCharm(object):
+    """Charm Store metadata for charm `name`.
+
+    With a `cache_dir`, the metadata is cached on disk. Metadata for an
+    unrevisioned name (which can change when a new revision is published)
+    expires after CHARMGUARDIAN_STORE_TTL seconds; revisioned names never
+    expire.
+
+    """
     STORE_URL = 'https://store.juju.ubuntu.com/charm-info'
 
-    def __init__(self, name):
+    def __init__(self, name, cache_dir=None):
         self.name = name
+        self.cache_dir = cache_dir
         self.data = self.fetch()
 
     def __getattr__(self, key):
         return self.data[key]
 
     def fetch(self):
+        cache = None
+        if self.cache_dir:
+            cache = JsonCache(os.path.join(self.cache_dir, 'charm-info'))
+            ttl = int(os.environ.get(
+                'CHARMGUARDIAN_STORE_TTL', STORE_TTL_SECS))
+            charm_data = cache.get(
+                self.name,
+                ttl=None if STORE_REVISION.search(self.name) else ttl)
+            if charm_data:
+                return charm_data
+
         params = {
             'stats': 0,
             'charms': self.name,
         }
         r = get(self.STORE_URL, params=params).json()
-        charm_data = r[self.name]
+        charm_data = r.get(self.name, {'errors': ['no data returned']})
         if 'errors' in charm_data:
             raise ValueError(
                 'Error retrieving "{}" from charm store: {}'.format(
                     self.name, '; '.join(charm_data['errors']))
             )
+        if cache:
+            cache.put(self.name, charm_data)
         return charm_data
 
 
@@ -171,44 +447,54 @@ class CharmstoreDownloader(Fetcher):
     """, re.VERBOSE)
 
     STORE_URL = 'https://store.juju.ubuntu.com/charm/'
+    ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+
+    _store_charm = None
 
-    def __init__(self, *args, **kw):
-        super(CharmstoreDownloader, self).__init__(*args, **kw)
-        self.charm = StoreCharm(self.charm)
+    @property
+    def store_charm(self):
+        # Resolved on first use rather than in get_fetcher()
+        if self._store_charm is None:
+            self._store_charm = StoreCharm(self.charm, self.cache_dir)
+        return self._store_charm
+
+    def canonical_url(self):
+        return self.store_charm.data['canonical-url']
+
+    def resolve_revision(self):
+        return str(self.store_charm.revision)
 
     def fetch(self, dir_):
-        url = self.charm.data['canonical-url'][len('cs:'):]
+        url = self.store_charm.data['canonical-url'][len('cs:'):]
         url = self.STORE_URL + url
-        archive = self.download_file(url, dir_)
-        charm_dir = self.extract_archive(archive, dir_)
+        # Charm archives are small enough to be held in memory; they only
+        # spill to disk if they're over ARCHIVE_SPOOL_SIZE.
+        with tempfile.SpooledTemporaryFile(
+                max_size=self.ARCHIVE_SPOOL_SIZE, dir=dir_) as archive:
+            self.download_file(url, archive)
+            archive.seek(0)
+            charm_dir = self.extract_archive(archive, dir_)
         return charm_dir
 
     def extract_archive(self, archive, dir_):
         tempdir = tempfile.mkdtemp(dir=dir_)
-        log.debug("Extracting %s to %s", archive, tempdir)
-        # Can't  extract with python due to bug that drops file
-        # permissions: http://bugs.python.org/issue15795
-        # In particular, it's important that executable test files in the
-        # archive remain executable, otherwise the tests won't be run.
-        # Instead we use a shell equivalent of the following:
-        #     archive = zipfile.ZipFile(archive, 'r')
-        #     archive.extractall(tempdir)
-        check_call('unzip {} -d {}'.format(archive, tempdir))
+        log.debug("Extracting charm archive to %s", tempdir)
+        try:
+            extract_zip(archive, tempdir)
+        except UnsafeArchiveError as e:
+            raise FetchError(str(e))
         return tempdir
 
-    def download_file(self, url, dir_):
-        _, filename = tempfile.mkstemp(dir=dir_)
+    def download_file(self, url, f):
         log.debug("Downloading %s", url)
-        r = get(url, stream=True)
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
-        return filename
+        try:
+            self.download_stats = download(
+                url, f, sha256=self.store_charm.data.get('sha256'))
+        except DownloadError as e:
+            raise FetchError(str(e))
 
     def get_revision(self, dir_):
-        return self.charm.revision
+        return self.store_charm.revision
 
 
 class BundleDownloader(Fetcher):
@@ -216,8 +502,14 @@ class BundleDownloader(Fetcher):
     ^bundle:(?P<bundle>.*)$
     """, re.VERBOSE)
 
+    def canonical_url(self):
+        return 'bundle:' + self.bundle
+
+    def resolve_revision(self):
+        return str(self.get_revision(None))
+
     def fetch(self, dir_):
-        url = Bundle(self.bundle).deployer_file_url
+        url = get_bundle(self.bundle, self.cache_dir).deployer_file_url
         bundle_dir = self.download_file(url, dir_)
         return bundle_dir
 
@@ -225,16 +517,172 @@ class BundleDownloader(Fetcher):
         bundle_dir = tempfile.mkdtemp(dir=dir_)
         bundle_file = os.path.join(bundle_dir, 'bundles.yaml')
         log.debug("Downloading %s to %s", url, bundle_file)
-        r = get(url, stream=True)
-        with open(bundle_file, 'w') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
+        try:
+            with open(bundle_file, 'wb') as f:
+                self.download_stats = download(url, f)
+        except DownloadError as e:
+            raise FetchError(str(e))
         return bundle_dir
 
     def get_revision(self, dir_):
-        return Bundle(self.bundle).basket_revision
+        return get_bundle(self.bundle, self.cache_dir).basket_revision
+
+
+class CachedFetcher(object):
+    """Wraps a Fetcher, consulting a FetchCache before fetching.
+
+    On a cache hit the cached tree is copied into place instead of being
+    fetched from the network. On a miss the tree is fetched as usual and
+    then stored in the cache.
+
+    """
+    def __init__(self, fetcher, cache):
+        self.fetcher = fetcher
+        self.cache = cache
+
+    def __getattr__(self, key):
+        return getattr(self.fetcher, key)
+
+    def fetch(self, dir_):
+        try:
+            key = self.fetcher.cache_key()
+        except FetchError as e:
+            log.debug('Not using fetch cache for %s: %s', self.fetcher.url, e)
+            key = None
+        if not key:
+            return self.fetcher.fetch(dir_)
+
+        digest = FetchCache.key(*key)
+        cached = self.cache.get(digest)
+        if cached:
+            log.debug('Fetch cache hit for %s', ' '.join(key))
+            dst = tempfile.mkdtemp(dir=dir_)
+            os.rmdir(dst)
+            try:
+                copy_tree(cached, dst)
+                return dst
+            except (OSError, shutil.Error) as e:
+                # Entry was evicted while we were copying it
+                log.debug('Fetch cache entry vanished: %s', e)
+                shutil.rmtree(dst, ignore_errors=True)
+
+        dst = self.fetcher.fetch(dir_)
+        self.cache.put(
+            digest, dst,
+            fetcher=key[0], url=key[1], revision=key[2],
+        )
+        return dst
+
+
+class MirrorPool(object):
+    """Local mirrors of remote git, hg and bzr repos.
+
+    The first fetch of a repo makes a full mirror of it; later fetches
+    only pull new revisions into the mirror. The requested revision is
+    then branched from the mirror into the target dir, which is a local
+    operation (git and hg hardlink the object store).
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def mirror_path(self, vcs, url):
+        return os.path.join(
+            self.path, vcs, hashlib.sha1(url.rstrip('/')).hexdigest())
+
+    @contextmanager
+    def update(self, vcs, url, create, pull):
+        """Create or update the mirror of `url`, holding a lock on it."""
+        mirror = self.mirror_path(vcs, url)
+        makedirs(os.path.dirname(mirror))
+        with open(mirror + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isdir(mirror):
+                    log.debug('Updating mirror of %s', url)
+                    pull(mirror)
+                else:
+                    log.debug('Mirroring %s to %s', url, mirror)
+                    try:
+                        create(mirror)
+                    except FetchError:
+                        shutil.rmtree(mirror, ignore_errors=True)
+                        raise
+                yield mirror
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def bzr(self, url, dir_, revision=None):
+        with self.update(
+                'bzr', url,
+                lambda m: bzr('branch --no-tree {} {}'.format(url, m)),
+                lambda m: bzr('pull --overwrite -d {} {}'.format(m, url)),
+        ) as mirror:
+            cmd = 'branch --use-existing-dir {} {}'.format(mirror, dir_)
+            if revision:
+                cmd = '{} -r {}'.format(cmd, revision)
+            bzr(cmd)
+        return dir_
+
+    def git(self, url, dir_, revision=None):
+        with self.update(
+                'git', url,
+                lambda m: git('clone --mirror {} {}'.format(url, m)),
+                lambda m: git('remote update --prune', cwd=m),
+        ) as mirror:
+            git('clone {} {}'.format(mirror, dir_))
+        git('remote set-url origin {}'.format(url), cwd=dir_)
+        if revision:
+            git('checkout {}'.format(revision), cwd=dir_)
+        return dir_
+
+    def hg(self, url, dir_, revision=None):
+        with self.update(
+                'hg', url,
+                lambda m: hg('clone -U {} {}'.format(url, m)),
+                lambda m: hg('pull -R {} {}'.format(m, url)),
+        ) as mirror:
+            cmd = 'clone {} {}'.format(mirror, dir_)
+            if revision:
+                cmd = '{} -u {}'.format(cmd, revision)
+            hg(cmd)
+        return dir_
+
+
+def resolve_git_revision(url, revision=None):
+    """Return the commit sha that `revision` refers to in remote `url`.
+
+    `revision` may be a branch or tag name, or a commit sha; defaults to
+    HEAD.
+
+    """
+    out = check_output('git ls-remote {} {}'.format(url, revision or 'HEAD'))
+    for line in out.splitlines():
+        return line.split()[0]
+    return revision
+
+
+def has_skipped(tests):
+    """Return True if any test record in the nested `tests` of a result
+    was skipped.
+
+    """
+    if isinstance(tests, dict):
+        return any(has_skipped(value) for value in tests.values())
+    if isinstance(tests, list):
+        return any(isinstance(record, dict) and record.get('skipped')
+                   for record in tests)
+    return False
+
+
+def parse_bzr_status(out):
+    """Return the paths listed by `bzr status --short`."""
+    paths = []
+    for line in out.splitlines():
+        path = line[4:].strip()
+        if path:
+            paths.extend(path.split(' => '))
+    return paths
 
 
 def bzr(cmd, **kw):
@@ -283,9 +731,15 @@ FETCHERS = [
 ]
 
 
-def get_fetcher(url, revision):
+def get_fetcher(url, revision, cache_dir=None, full_clone=False):
     for fetcher in FETCHERS:
         matchdict = fetcher.can_fetch(url)
         if matchdict:
-            return fetcher(url, revision, **matchdict)
+            fetcher = fetcher(
+                url, revision,
+                cache_dir=cache_dir, full_clone=full_clone, **matchdict)
+            if cache_dir:
+                cache = FetchCache(os.path.join(cache_dir, 'trees'))
+                fetcher = CachedFetcher(fetcher, cache)
+            return fetcher
     raise ValueError('No fetcher for url: %s' % url)
@@ -0,0 +1,74 @@
+"""
+Decides how much testing a change needs, from the files it changes.
+
+Each changed file is put in a category, and each category needs one of
+three tiers of testing:
+
+    proof   only `charm proof` (docs)
+    charm   the charm's own tests, but not the bundles that use it (tests)
+    full    charm and bundle tests (hooks, metadata, config and anything
+            not otherwise recognized)
+
+A change gets the highest tier needed by any of its files.
+
+"""
+import fnmatch
+
+PROOF = 'proof'
+CHARM = 'charm'
+FULL = 'full'
+
+TIERS = [PROOF, CHARM, FULL]
+
+# (category, tier, patterns), checked in order; the first match wins
+CATEGORIES = [
+    ('docs', PROOF, [
+        'README*', 'readme*', '*.md', '*.rst', 'doc/*', 'docs/*',
+        'copyright', 'LICENSE*', 'HACKING*', 'icon.svg',
+    ]),
+    ('tests', CHARM, [
+        'tests/*', 'unit_tests/*', 'Makefile', 'tox.ini',
+    ]),
+    ('metadata', FULL, [
+        'metadata.yaml', 'revision', 'bundles.yaml', 'bundle.yaml',
+    ]),
+    ('config', FULL, [
+        'config.yaml', 'actions.yaml',
+    ]),
+]
+DEFAULT_CATEGORY = ('hooks', FULL)
+
+
+def classify(path):
+    """Return the (category, tier) of the file at relative `path`."""
+    if path.startswith('./'):
+        path = path[2:]
+    for category, tier, patterns in CATEGORIES:
+        for pattern in patterns:
+            if fnmatch.fnmatch(path, pattern):
+                return category, tier
+    return DEFAULT_CATEGORY
+
+
+def analyze(files):
+    """Return the tier of testing needed for a change to `files`.
+
+    The result is a dict with the 'tier', the 'reason' it was chosen,
+    and the changed 'files' by category.
+
+    """
+    by_category = {}
+    tier, reason = PROOF, 'No files changed'
+    for path in files:
+        category, file_tier = classify(path)
+        by_category.setdefault(category, []).append(path)
+        if TIERS.index(file_tier) > TIERS.index(tier):
+            tier = file_tier
+            reason = '{} changed: {}'.format(category, path)
+    if files and tier == PROOF:
+        reason = 'Only docs changed'
+    return {
+        'tier': tier,
+        'reason': reason,
+        'files': by_category,
+    }
@@ -0,0 +1,79 @@
+"""
+Parsed bundles.yaml and metadata.yaml files.
+
+Each file is parsed once, when first needed, and written back only if it
+was changed. Parsing always uses a safe loader, backed by libyaml where
+it's available, as some bundle files are large.
+
+"""
+import logging
+import os
+
+import yaml
+
+try:
+    from yaml import (
+        CSafeDumper as SafeDumper,
+        CSafeLoader as SafeLoader,
+    )
+except ImportError:
+    from yaml import (
+        SafeDumper,
+        SafeLoader,
+    )
+
+log = logging.getLogger(__name__)
+
+
+class YamlFile(object):
+    """A yaml file in a charm or bundle dir."""
+    filename = None
+
+    def __init__(self, dir_):
+        self.path = os.path.join(dir_, self.filename)
+        self.dirty = False
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, 'r') as f:
+                self._data = yaml.load(f, Loader=SafeLoader) or {}
+        return self._data
+
+    def save(self):
+        """Write the data back to the file, if it has been changed."""
+        if not self.dirty:
+            return
+        with open(self.path, 'w') as f:
+            yaml.dump(self.data, f, Dumper=SafeDumper,
+                      default_flow_style=False)
+        self.dirty = False
+
+
+class BundleSpec(YamlFile):
+    filename = 'bundles.yaml'
+
+    def deployments(self):
+        return self.data.keys()
+
+    def swap_charm(self, charm_name, charmdir):
+        """Deploy `charmdir` in place of charm `charm_name` in every
+        deployment.
+
+        """
+        for bundle in self.data.itervalues():
+            for svc in bundle['services'].itervalues():
+                # TODO make this comparison more precise
+                if charm_name in svc.get('charm', {}):
+                    svc['branch'] = charmdir
+                    del svc['charm']
+                    self.dirty = True
+
+
+class CharmMetadata(YamlFile):
+    filename = 'metadata.yaml'
+
+    @property
+    def name(self):
+        return self.data['name']
@@ -0,0 +1,96 @@
+"""
+Cached bundletester results.
+
+A passing bundletester result is stored under a key made of a digest of
+the tested tree, the environment, the bundletester arguments and the
+bundletester version. A test whose key matches a stored result isn't run
+again; the stored result is returned instead, with 'cached': True in each
+of its records.
+
+Results are kept for CHARMGUARDIAN_RESULT_TTL seconds (default 604800,
+one week). Failures are never cached, so they're always retried.
+
+"""
+import json
+import logging
+import os
+
+import pkg_resources
+
+from .cache import JsonCache
+from .tree import tree_digest
+from .util import (
+    get_test_result,
+    is_skipped,
+)
+
+log = logging.getLogger(__name__)
+
+RESULT_TTL_SECS = 7 * 24 * 60 * 60
+
+# Files in a test dir that don't affect the tests: VCS metadata, and what
+# bundletester itself writes there
+DIGEST_IGNORE = [
+    '.bzr', '.git', '.hg', '.deployer-branches', 'result-*.json',
+    'bundletester-*.log',
+]
+
+
+def get_ttl():
+    return int(os.environ.get('CHARMGUARDIAN_RESULT_TTL', RESULT_TTL_SECS))
+
+
+def bundletester_version():
+    try:
+        return pkg_resources.get_distribution('bundletester').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def digest(dir_):
+    """Return a digest of the parts of the test dir `dir_` that can affect
+    its test results.
+
+    """
+    return tree_digest(dir_, DIGEST_IGNORE)
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir):
+        self.cache = JsonCache(os.path.join(cache_dir, 'results'), get_ttl())
+
+    @classmethod
+    def get_cache(cls, cache_dir):
+        """Return a ResultCache in `cache_dir`, or None if results can't
+        be cached.
+
+        """
+        if not cache_dir:
+            return None
+        if not bundletester_version():
+            log.debug('Not caching results: bundletester version unknown')
+            return None
+        return cls(cache_dir)
+
+    @staticmethod
+    def key(digest, env, **kw):
+        """Return the key of results of testing a tree with `digest` in
+        `env`, where `kw` are the arguments to `util.bundletester`.
+
+        """
+        return json.dumps(
+            [digest, env, bundletester_version(), sorted(kw.items())])
+
+    def get(self, key):
+        result = self.cache.get(key)
+        if result is None:
+            return None
+        log.debug('Using cached result for %s', key)
+        return [dict(record, cached=True) for record in result]
+
+    def put(self, key, result):
+        if get_test_result(result) != 'pass' or is_skipped(result):
+            return
+        if any(record.get('cached') for record in result):
+            return
+        self.cache.put(key, result)
@@ -0,0 +1,455 @@
+"""
+Runs test jobs under per-environment and global concurrency limits.
+
+All jobs in a charmguardian run, including those of nested bundle tests,
+go through one process-wide Scheduler. A job is started as soon as both
+its environment and the run as a whole have a free slot.
+
+Limits are read from the environment:
+
+    CHARMGUARDIAN_MAX_JOBS      max jobs running at once (default: no limit
+                                beyond the per-env ones)
+    CHARMGUARDIAN_ENV_LIMITS    per-env limits, e.g. 'local=1,amazon=6'
+                                (default: 1; warm envs, see envpool, are
+                                always limited to 1)
+    CHARMGUARDIAN_EXECUTOR      'process' (default) to run each job in a
+                                forked worker process, or 'thread' to run
+                                jobs in threads of this process
+
+An env runs one job at a time unless CHARMGUARDIAN_ENV_LIMITS says
+otherwise: bundletester bootstraps the env it's given and destroys it when
+it's done, so concurrent runs in one env would destroy each other's. Only
+raise the limit for envs that can take it.
+
+Jobs mostly wait on bundletester, so with the thread executor many more of
+them can run at once without the cost of a process each.
+
+When the scheduler is terminated, running jobs are first asked to stop:
+bundletester checks `cancelled()` while it streams output, and kills its
+process group, and a leased warm env is then reset as usual. Worker
+processes still busy after WORKER_STOP_TIMEOUT_SECS are killed, and kill
+whatever they registered with `cleanup_on_terminate` on the way out.
+Threads can't be killed, though: a job busy with anything else (charm
+proof, bootstrapping or resetting a warm env) runs on, and is abandoned
+after THREAD_JOIN_TIMEOUT_SECS.
+
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import itertools
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import signal
+import threading
+import traceback
+
+from . import events
+from .envpool import get_warm_envs
+
+log = logging.getLogger(__name__)
+
+_scheduler = None
+_lock = threading.Lock()
+
+# In a worker, the Event set when its scheduler's jobs are cancelled
+_cancel_event = None
+# The same, for worker threads
+_local = threading.local()
+# In a worker process, what to call if it's terminated mid-job
+_cleanups = []
+
+# Jobs that may run at once in an env not in CHARMGUARDIAN_ENV_LIMITS
+ENV_LIMIT = 1
+
+PROCESS = 'process'
+THREAD = 'thread'
+
+# How long terminate() waits for worker threads to stop
+THREAD_JOIN_TIMEOUT_SECS = 30
+# How long terminate() lets worker processes finish their jobs before
+# killing them
+WORKER_STOP_TIMEOUT_SECS = 30
+
+
+def init_worker(cancel_event=None):
+    global _cancel_event
+    _cancel_event = cancel_event
+    # Ctrl-C is handled by the main process, which terminates the pool.
+    # SIGTERM must still stop the worker: Pool.terminate() relies on it to
+    # stop workers that are busy, and hangs waiting on them otherwise.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def handle_sigterm(signum, frame):
+    """Run the cleanups of the job in hand, then die of SIGTERM."""
+    for func in reversed(_cleanups):
+        try:
+            func()
+        except Exception:
+            log.exception('Cleanup of terminated worker failed')
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+@contextmanager
+def cleanup_on_terminate(func):
+    """Call `func` if this worker process is terminated within the block,
+    e.g. to kill a process it started.
+
+    """
+    _cleanups.append(func)
+    try:
+        yield
+    finally:
+        _cleanups.remove(func)
+
+
+def init_thread(cancel_event):
+    _local.cancel_event = cancel_event
+
+
+@contextmanager
+def signal_handlers(scheduler):
+    """Terminate `scheduler` on SIGINT/SIGTERM, then call the previous
+    handler.
+
+    Signal handlers can only be installed from the main thread, so this
+    does nothing in other threads.
+
+    """
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        yield
+        return
+
+    def install_handler(signum):
+        cur_handler = signal.getsignal(signum)
+
+        def handler(signum, frame):
+            scheduler.terminate()
+            if callable(cur_handler):
+                cur_handler(signum, frame)
+        signal.signal(signum, handler)
+        return cur_handler
+
+    prev_sigint_handler = install_handler(signal.SIGINT)
+    prev_sigterm_handler = install_handler(signal.SIGTERM)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, prev_sigint_handler)
+        signal.signal(signal.SIGTERM, prev_sigterm_handler)
+
+
+def cancelled():
+    """Return True if the job running in this worker should stop early."""
+    cancel_event = getattr(_local, 'cancel_event', None) or _cancel_event
+    return bool(cancel_event and cancel_event.is_set())
+
+
+def get_max_jobs():
+    max_jobs = os.environ.get('CHARMGUARDIAN_MAX_JOBS')
+    return int(max_jobs) if max_jobs else None
+
+
+def get_executor():
+    executor = os.environ.get('CHARMGUARDIAN_EXECUTOR', PROCESS)
+    if executor not in (PROCESS, THREAD):
+        raise ValueError(
+            'Invalid CHARMGUARDIAN_EXECUTOR: {}'.format(executor))
+    return executor
+
+
+def get_env_limits():
+    limits = {}
+    for item in os.environ.get('CHARMGUARDIAN_ENV_LIMITS', '').split(','):
+        if '=' in item:
+            env, limit = item.split('=', 1)
+            limits[env.strip()] = int(limit)
+    # A warm env is leased to one test at a time
+    limits.update(dict.fromkeys(get_warm_envs(), 1))
+    return limits
+
+
+def get_scheduler():
+    """Return the Scheduler shared by all testers in this process."""
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(
+                get_env_limits(), get_max_jobs(), get_executor())
+        return _scheduler
+
+
+def call(func, args, kw):
+    """Run a job in a worker, returning (ok, result or error, traceback)."""
+    try:
+        return True, func(*args, **kw), None
+    except Exception as e:
+        return False, e, traceback.format_exc()
+
+
+class JobError(Exception):
+    pass
+
+
+class JobCancelled(JobError):
+    pass
+
+
+class Job(object):
+    def __init__(self, env, func, args, kw, id=None):
+        # Numbered by the Scheduler that made the job, see Scheduler.job
+        self.id = id
+        self.env = env
+        self.func = func
+        self.args = args
+        self.kw = kw
+        # The Scheduler the job was submitted to
+        self.scheduler = None
+        self._done = threading.Event()
+        self._result = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def set_result(self, outcome):
+        """Set the (ok, result or error, traceback) outcome of the job.
+
+        Callbacks run before the job is marked ready, so that waiters see
+        their effects.
+
+        """
+        with self._lock:
+            self._result = outcome
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+        self._done.set()
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.debug('Job callback failed', exc_info=True)
+
+    def add_done_callback(self, callback):
+        """Call callback(job) when this job finishes (now, if it has).
+
+        Callbacks should use `result`, not `get`, to read the result.
+
+        """
+        with self._lock:
+            if self._result is None:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def result(self):
+        """Return the result of the finished job.
+
+        Re-raises any exception raised by the job.
+
+        """
+        ok, value, tb = self._result
+        if not ok:
+            if tb:
+                log.debug('Job failed: %s', tb)
+            raise value
+        return value
+
+    def get(self):
+        """Wait for the job to finish and return its result."""
+        # Waiting without a timeout would block signal delivery
+        while not self._done.wait(1):
+            pass
+        return self.result()
+
+
+class Scheduler(object):
+    """Runs jobs in workers, within per-env and global limits.
+
+    Workers are forked processes, or threads if `executor` is THREAD. They
+    are all started at once, by `start`, as many as the envs the jobs will
+    run in can use, and are reused by later jobs until the scheduler is
+    terminated. Jobs are only handed to the pool when the limits and the
+    pool size allow them to run, so a job never waits in the pool itself.
+
+    Forking a process that has other threads running can deadlock the
+    child on locks those threads hold, so `start` should be called from
+    the main thread before any other threads (e.g. a Prefetcher's) are
+    started.
+
+    """
+    def __init__(self, env_limits=None, max_jobs=None, executor=PROCESS):
+        self.env_limits = env_limits or {}
+        self.max_jobs = max_jobs
+        self.executor = executor
+        self.queue = []
+        self.active = set()
+        self.running = defaultdict(int)
+        self.pool = None
+        self.size = 0
+        self._job_ids = itertools.count(1)
+        self.lock = threading.RLock()
+        if executor == THREAD:
+            self.cancel_event = threading.Event()
+        else:
+            self.cancel_event = multiprocessing.Event()
+
+    def start(self, envs=None):
+        """Start the workers, if they haven't been started already.
+
+        Enough are started to run as many jobs at once as `envs`, the
+        envs jobs will run in, allow. Without `envs`, `max_jobs` are
+        started, or one if there's no max.
+
+        """
+        with self.lock:
+            if self.pool is not None:
+                return
+            if envs:
+                size = sum(self.limit(env) for env in set(envs))
+                if self.max_jobs:
+                    size = min(size, self.max_jobs)
+            else:
+                size = self.max_jobs or 1
+            if not isinstance(threading.current_thread(),
+                              threading._MainThread):
+                log.debug('Starting workers outside the main thread')
+            log.debug('Starting %s workers', size)
+            if self.executor == THREAD:
+                self.pool = ThreadPool(
+                    size, init_thread, (self.cancel_event,))
+            else:
+                self.pool = multiprocessing.Pool(
+                    size, init_worker, (self.cancel_event,))
+            self.size = size
+
+    def limit(self, env):
+        limit = self.env_limits.get(env, ENV_LIMIT)
+        return min(limit, self.max_jobs) if self.max_jobs else limit
+
+    def submit(self, env, func, *args, **kw):
+        """Queue a call to func(*args, **kw) that runs in environment `env`.
+
+        Returns a Job whose get() method returns the result.
+
+        """
+        return self.submit_job(self.job(env, func, *args, **kw))
+
+    def job(self, env, func, *args, **kw):
+        """Return a Job, numbered within this scheduler, for a call to
+        func(*args, **kw) in environment `env`.
+
+        """
+        return Job(env, func, args, kw, id=next(self._job_ids))
+
+    def submit_job(self, job):
+        """Queue `job`, returning it."""
+        job.scheduler = self
+        with self.lock:
+            is_cancelled = self.cancel_event.is_set()
+            if not is_cancelled:
+                self.queue.append(job)
+                self._dispatch()
+        if is_cancelled:
+            job.set_result((False, JobCancelled('Job cancelled'), None))
+        return job
+
+    def _dispatch(self):
+        if self.queue:
+            self.start()
+        for job in list(self.queue):
+            if sum(self.running.values()) >= self.size:
+                break
+            if self.running[job.env] >= self.limit(job.env):
+                continue
+            self.queue.remove(job)
+            self.running[job.env] += 1
+            self._start(job)
+
+    def _start(self, job):
+        log.debug('Starting %s job (%s running)', job.env,
+                  sum(self.running.values()))
+        self.active.add(job)
+        events.emit('env-started', job=job.id, env=job.env)
+        self.pool.apply_async(
+            call, (job.func, job.args, job.kw),
+            callback=lambda outcome: self._finished(job, outcome))
+
+    def _finished(self, job, outcome):
+        with self.lock:
+            if job not in self.active:
+                return
+            self.active.remove(job)
+            self.running[job.env] -= 1
+        # Callbacks may cancel the queued jobs, so run them before
+        # starting any
+        job.set_result(outcome)
+        with self.lock:
+            self._dispatch()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """Cancel queued and future jobs, and ask running ones to stop.
+
+        Queued jobs fail with JobCancelled. Running jobs can check
+        `cancelled()` and return early.
+
+        """
+        log.debug('Cancelling jobs')
+        with self.lock:
+            self.cancel_event.set()
+            jobs, self.queue = self.queue, []
+        for job in jobs:
+            job.set_result((False, JobCancelled('Job cancelled'), None))
+
+    def terminate(self):
+        """Stop all running jobs and fail them and any queued ones."""
+        with self.lock:
+            jobs = self.queue + list(self.active)
+            pool, self.pool = self.pool, None
+            self.size = 0
+            self.queue, self.active = [], set()
+            self.running.clear()
+        # Running jobs stop themselves, and clean up, if they can
+        self.cancel_event.set()
+        if pool:
+            if self.executor == THREAD:
+                # Threads can't be killed
+                pool.terminate()
+                if not join_pool(pool, THREAD_JOIN_TIMEOUT_SECS):
+                    log.debug('Abandoning worker threads still running '
+                              'after %ss', THREAD_JOIN_TIMEOUT_SECS)
+            else:
+                pool.close()
+                if not join_pool(pool, WORKER_STOP_TIMEOUT_SECS):
+                    log.debug('Killing worker processes still running '
+                              'after %ss', WORKER_STOP_TIMEOUT_SECS)
+                pool.terminate()
+                pool.join()
+        for job in jobs:
+            job.set_result((False, JobError('Job cancelled'), None))
+
+
+def join_pool(pool, timeout):
+    """Wait up to `timeout` seconds for the workers of `pool`, which must
+    be closed or terminated, to stop. Returns True if they did.
+
+    Pool.join() waits for running jobs however long they take. A
+    ThreadPool's threads are daemon threads, so any left running won't
+    stop the process exiting.
+
+    """
+    joiner = threading.Thread(target=pool.join)
+    joiner.daemon = True
+    joiner.start()
+    joiner.join(timeout)
+    return not joiner.is_alive()
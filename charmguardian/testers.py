@@ -1,87 +1,309 @@
-from contextlib import contextmanager
+import fnmatch
+import hashlib
 import logging
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
-import random
 import shutil
-import signal
 import tempfile
-import yaml
 
 from amulet.helpers import setup_bzr, run_bzr
-from charmworldlib.bundle import Bundles
 
+from . import events
+from .cache import FetchCache
+from .charmworld import search_bundles
+from .deployments import (
+    DeploymentHistory,
+    choose_deployments,
+)
+from .envpool import (
+    get_env_pool,
+    run_leased,
+)
 from .fetchers import (
     get_fetcher,
     FetchError,
 )
+from .impact import (
+    CHARM,
+    FULL,
+    PROOF,
+    analyze,
+)
+from .model import (
+    BundleSpec,
+    CharmMetadata,
+)
+from .results import (
+    DIGEST_IGNORE,
+    ResultCache,
+    digest,
+)
+from .scheduler import (
+    JobCancelled,
+    get_scheduler,
+    signal_handlers,
+)
+from .tree import (
+    copy_tree,
+    move_tree,
+)
 from .util import (
     bundletester,
+    charm_proof,
     get_charm_test_envs,
     get_bundle_test_envs,
     get_test_result,
+    is_skipped,
+    skipped_result,
     timestamp,
 )
 
 log = logging.getLogger(__name__)
 
+PREFETCH_THREADS = 8
+BUNDLE_THREADS = 4
 
-def init_worker():
-    signal.signal(signal.SIGTERM, signal.SIG_IGN)
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+def get_bundle_threads():
+    return int(os.environ.get('CHARMGUARDIAN_BUNDLE_JOBS', BUNDLE_THREADS))
 
-@contextmanager
-def signal_handlers(pool):
-    def install_handler(signum):
-        cur_handler = signal.getsignal(signum)
 
-        def handler(signum, frame):
-            pool.terminate()
-            pool.join()
-            if callable(cur_handler):
-                cur_handler(signum, frame)
-        signal.signal(signum, handler)
-        return cur_handler
+def start_scheduler():
+    """Start the scheduler's workers, as many as the test envs can use."""
+    get_scheduler().start(get_charm_test_envs() + get_bundle_test_envs())
+
+
+class Prefetcher(object):
+    """Fetches urls in background threads while other work proceeds.
+
+    Fetched trees are written to a temp dir in `workspace` (or the
+    platform default location), which is removed by `close` unless a
+    workspace was given.
+
+    The scheduler's worker processes are forked before the fetch threads
+    start, as forking while they run could deadlock a worker.
+
+    """
+    def __init__(self, workspace=None, threads=PREFETCH_THREADS, **kw):
+        start_scheduler()
+        self.workspace = workspace
+        self.dir_ = tempfile.mkdtemp(dir=workspace)
+        self.pool = ThreadPool(threads)
+        self.kw = kw
+
+    def start(self, url, revision=None, dir_=None):
+        """Start fetching `url` into `dir_`, a dir within `self.dir_`
+        (default: `self.dir_` itself).
+
+        Returns an AsyncResult whose get() returns (fetcher, test_dir).
+
+        """
+        log.debug('Prefetching %s', url)
+        return self.pool.apply_async(
+            fetch, (url, revision, dir_ or self.dir_), self.kw)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if not self.workspace:
+            shutil.rmtree(self.dir_)
 
-    prev_sigint_handler = install_handler(signal.SIGINT)
-    prev_sigterm_handler = install_handler(signal.SIGTERM)
+
+def make_deployer_branch(charmdir, dir_):
+    """Make a bzr branch of the charm at `charmdir` in `dir_`, which must
+    not exist, for bundles to deploy the charm from.
+
+    Files that tests leave in a charm dir, and other VCS metadata, are
+    left out.
+
+    """
+    copy_tree(charmdir, dir_)
+    for name in os.listdir(dir_):
+        if any(fnmatch.fnmatch(name, pattern) for pattern in DIGEST_IGNORE):
+            path = os.path.join(dir_, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    setup_bzr(dir_)
+    run_bzr(["add", "."], dir_)
+    run_bzr([
+        "commit", "--unchanged", "-m",
+        "Creating local branch for deployer"],
+        dir_)
+    return dir_
+
+
+def cancel_on_failure(job):
+    """Job callback that cancels all other jobs of the scheduler that ran
+    `job`, if it failed.
+
+    """
     try:
-        yield
-    finally:
-        signal.signal(signal.SIGINT, prev_sigint_handler)
-        signal.signal(signal.SIGTERM, prev_sigterm_handler)
+        failed = get_test_result(job.result()) == 'fail'
+    except JobCancelled:
+        failed = False
+    except Exception:
+        failed = True
+    if failed and job.scheduler:
+        job.scheduler.cancel()
+
+
+def get_job_result(job):
+    """Return the bundletester result of `job`, or a skipped result if the
+    job was cancelled before it started.
+
+    """
+    try:
+        return job.get()
+    except JobCancelled:
+        return [skipped_result()]
 
 
 class Tester(object):
+    url = None
+    cache_dir = None
+    fail_fast = False
+    all_deployments = False
+    digest = None
+
     def __init__(self, test_dir):
         self.test_dir = test_dir
 
+    def get_digest(self):
+        """Return a digest of everything under test, for result caching."""
+        if self.digest is None:
+            self.digest = digest(self.test_dir)
+        return self.digest
+
+    def proof(self, typ):
+        """Run only `charm proof`, for changes that can't affect tests."""
+        proof = [charm_proof(self.test_dir)]
+        tests = {'proof': proof}
+        return {
+            'type': typ,
+            'result': get_test_result(proof),
+            'tests': {
+                'charm': tests,
+                'bundle': {},
+            } if typ == 'charm' else {'proof': tests},
+        }
+
+    def _submit(self, env, **kw):
+        """Queue a bundletester run of this tester's dir in `env`.
+
+        With fail_fast set, a failure cancels all other queued and
+        running jobs.
+
+        """
+        pool = get_env_pool(self.cache_dir)
+        results = ResultCache.get_cache(self.cache_dir)
+        key = results.key(self.get_digest(), env, **kw) if results else None
+        cached = results.get(key) if results else None
+        scheduler = get_scheduler()
+        if pool and env in pool.envs:
+            job = scheduler.job(env, run_leased, pool, env,
+                                bundletester, self.test_dir, env, **kw)
+        else:
+            job = scheduler.job(env, bundletester, self.test_dir, env, **kw)
+        events.emit('job-queued', job=job.id, env=env, url=self.url,
+                    deployment=kw.get('deployment'))
+
+        if results and not cached:
+            job.add_done_callback(lambda job: results.put(key, job.result()))
+        job.add_done_callback(self._job_finished)
+        if self.fail_fast:
+            job.add_done_callback(cancel_on_failure)
+
+        if cached:
+            job.scheduler = scheduler
+            job.set_result((True, cached, None))
+        else:
+            scheduler.submit_job(job)
+        return job
+
+    def _job_finished(self, job):
+        info = dict(job=job.id, env=job.env, url=self.url,
+                    deployment=job.kw.get('deployment'))
+        try:
+            records = job.result()
+        except JobCancelled:
+            records = [skipped_result()]
+        except Exception as e:
+            events.emit('job-finished', result='error', error=str(e), **info)
+            return
+        for record in records:
+            events.emit('test-finished', record=record, **info)
+        result = get_test_result(records)
+        if result == 'pass' and is_skipped(records):
+            result = 'skipped'
+        events.emit('job-finished', result=result, cached=any(
+            record.get('cached') for record in records), **info)
+
 
 class BundleTester(Tester):
     @staticmethod
     def can_test(dir_):
         return 'bundles.yaml' in os.listdir(dir_)
 
+    def __init__(self, test_dir):
+        super(BundleTester, self).__init__(test_dir)
+        self.spec = BundleSpec(test_dir)
+
     def test(self, shallow=False, workspace=None, constraints=None,
-             charm_name=None, charmdir=None):
+             cache_dir=None, charm_name=None, charmdir=None,
+             fail_fast=False, tier=FULL, all_deployments=False):
         bundle_tests = {}
         result = 'pass'
         exclude = None
+        self.cache_dir = cache_dir
+        self.fail_fast = fail_fast
+        self.all_deployments = all_deployments
+
+        if tier == PROOF:
+            return self.proof('bundle')
+
+        if charm_name and charmdir and ResultCache.get_cache(cache_dir):
+            # Results depend on the charm swapped into the bundle, not on
+            # where it happens to be
+            self.digest = hashlib.sha1(
+                self.get_digest() + digest(charmdir)).hexdigest()
 
         if charm_name and charmdir:
-            self._ensure_bzr(charmdir)
+            if not os.path.exists(os.path.join(charmdir, '.bzr')):
+                # Deployer needs a branch; make one rather than turn
+                # `charmdir`, which may be shared, into one
+                charmdir = make_deployer_branch(charmdir, os.path.join(
+                    tempfile.mkdtemp(dir=os.path.dirname(self.test_dir)),
+                    charm_name))
             self._swap_charm(charm_name, charmdir)
             exclude = charm_name
 
-        for deployment in self._choose_deployments():
-            envs = get_bundle_test_envs()
-            bundle_tests[deployment] = self._multi_test(
-                envs, deployment, exclude, constraints)
-            for env in envs:
-                if result != 'pass':
-                    break
-                result = get_test_result(bundle_tests[deployment][env])
+        envs = get_bundle_test_envs()
+        with signal_handlers(get_scheduler()):
+            # Queue every deployment before waiting on any of them
+            jobs = {
+                deployment: self._multi_test(
+                    envs, deployment, exclude, constraints)
+                for deployment in self._choose_deployments()}
+            for deployment, env_jobs in jobs.items():
+                bundle_tests[deployment] = {
+                    env: get_job_result(job) for env, job in env_jobs.items()}
+                for env in envs:
+                    if result != 'pass':
+                        break
+                    result = get_test_result(bundle_tests[deployment][env])
+
+        history = self.history
+        if history:
+            history.record(self.url, [
+                deployment for deployment, env_tests in bundle_tests.items()
+                if not all(is_skipped(tests) for tests in env_tests.values())])
+
+        if result == 'pass' and bundle_tests and all(
+                is_skipped(tests) for env_tests in bundle_tests.values()
+                for tests in env_tests.values()):
+            result = 'skipped'
 
         return {
             'type': 'bundle',
@@ -90,58 +312,40 @@ class BundleTester(Tester):
         }
 
     def _multi_test(self, envs, deployment, exclude, constraints):
-        results = {}
-        pool = multiprocessing.Pool(None, init_worker)
-        with signal_handlers(pool):
-            for env in envs:
-                log.debug(
-                    'Testing deployment %s in env %s', deployment, env)
-                results[env] = pool.apply_async(
-                    bundletester,
-                    (self.test_dir, env),
-                    dict(
-                        deployment=deployment,
-                        exclude=exclude,
-                        skip_implicit=True,
-                        constraints=constraints,
-                    )
-                )
-
-            for env, result in results.items():
-                results[env] = result.get()
-
-        return results
-
-    def _ensure_bzr(self, charmdir):
-        if os.path.exists(os.path.join(charmdir, '.bzr')):
-            return
+        """Queue tests of `deployment` in each of `envs`.
 
-        setup_bzr(charmdir)
-        run_bzr(["add", "."], charmdir)
-        run_bzr([
-            "commit", "--unchanged", "-m",
-            "Creating local branch for deployer"],
-            charmdir)
+        Returns a dict of env: Job.
+
+        """
+        jobs = {}
+        for env in envs:
+            log.debug(
+                'Testing deployment %s in env %s', deployment, env)
+            jobs[env] = self._submit(
+                env,
+                deployment=deployment,
+                exclude=exclude,
+                skip_implicit=True,
+                constraints=constraints,
+            )
+        return jobs
 
     def _swap_charm(self, charm_name, charmdir):
-        bundle_file = os.path.join(self.test_dir, 'bundles.yaml')
-        with open(bundle_file, 'r') as f:
-            bundle_data = yaml.load(f)
-        for bundle in bundle_data.itervalues():
-            for svc in bundle['services'].itervalues():
-                # TODO make this comparison more precise
-                if charm_name in svc.get('charm', {}):
-                    svc['branch'] = charmdir
-                    del svc['charm']
-        with open(bundle_file, 'w') as f:
-            f.write(yaml.dump(bundle_data, default_flow_style=False))
+        self.spec.swap_charm(charm_name, charmdir)
+        self.spec.save()
+
+    @property
+    def history(self):
+        if not (self.cache_dir and self.url):
+            return None
+        return DeploymentHistory(self.cache_dir)
 
     def _choose_deployments(self):
-        bundle_file = os.path.join(self.test_dir, 'bundles.yaml')
-        with open(bundle_file, 'r') as f:
-            bundle_data = yaml.load(f)
-            log.debug('Deployments: %s', bundle_data.keys())
-            return [random.choice(bundle_data.keys())]
+        deployments = self.spec.deployments()
+        log.debug('Deployments: %s', deployments)
+        if self.all_deployments:
+            return sorted(deployments)
+        return choose_deployments(deployments, self.history, self.url)
 
 
 class CharmTester(Tester):
@@ -151,62 +355,82 @@ class CharmTester(Tester):
 
     def __init__(self, test_dir):
         super(CharmTester, self).__init__(test_dir)
-        self.charm_name = self._get_charm_name()
-
-    def _get_charm_name(self):
-        metadata_file = os.path.join(self.test_dir, 'metadata.yaml')
-        with open(metadata_file, 'r') as f:
-            metadata = yaml.load(f)
-            return metadata['name']
+        self.metadata = CharmMetadata(test_dir)
+        self.charm_name = self.metadata.name
 
     def _multi_test(self, envs, constraints):
-        results = {}
-        pool = multiprocessing.Pool(None, init_worker)
-        with signal_handlers(pool):
+        jobs = {}
+        with signal_handlers(get_scheduler()):
             for env in envs:
                 log.debug('Testing Charm %s in env %s', self.charm_name, env)
-                results[env] = pool.apply_async(
-                    bundletester,
-                    (self.test_dir, env),
-                    dict(
-                        constraints=constraints,
-                    )
-                )
+                jobs[env] = self._submit(env, constraints=constraints)
 
-            for env, result in results.items():
-                results[env] = result.get()
+            return {env: get_job_result(job) for env, job in jobs.items()}
 
-        return results
-
-    def test(self, shallow=False, workspace=None, constraints=None):
+    def test(self, shallow=False, workspace=None, constraints=None,
+             cache_dir=None, fail_fast=False, tier=FULL,
+             all_deployments=False):
         charm_tests, bundle_tests = {}, {}
         result = 'pass'
+        self.cache_dir = cache_dir
+        self.fail_fast = fail_fast
+        self.all_deployments = all_deployments
 
         # to avoid charm-proof warnings, dir name must match charm name
-        if os.path.basename(self.test_dir.rstrip('/')) != self.charm_name:
-            new_test_dir = os.path.join(self.test_dir, self.charm_name)
-            shutil.copytree(self.test_dir, new_test_dir, symlinks=True)
+        test_dir = self.test_dir.rstrip('/')
+        if os.path.basename(test_dir) != self.charm_name:
+            new_test_dir = os.path.join(
+                tempfile.mkdtemp(dir=os.path.dirname(test_dir)),
+                self.charm_name)
+            move_tree(test_dir, new_test_dir)
             self.test_dir = new_test_dir
 
-        envs = get_charm_test_envs()
-        charm_tests = self._multi_test(envs, constraints)
-        for env in envs:
-            if result != 'pass':
-                break
-            result = get_test_result(charm_tests[env])
+        if tier == PROOF:
+            return self.proof('charm')
+        if tier == CHARM:
+            shallow = True
 
+        # Fetch the bundles while the charm tests run, so that bundle
+        # tests can start without waiting on Launchpad. Each bundle gets
+        # its own workspace, so concurrent bundle tests don't collide.
+        bundles, prefetcher, fetched = [], None, {}
         if not shallow:
-            for bundle in self.bundles():
-                log.debug('Testing bundle %s', bundle.id)
-                bundle_tests[bundle.id] = test(
-                    'lp:' + bundle.branch_spec,
-                    workspace=workspace,
-                    constraints=constraints,
-                    charm_name=self.charm_name,
-                    charmdir=self.test_dir)
+            bundles = self.bundles()
+        if bundles:
+            prefetcher = Prefetcher(
+                workspace,
+                threads=min(len(bundles), PREFETCH_THREADS),
+                cache_dir=cache_dir)
+            for bundle in bundles:
+                bundle_workspace = tempfile.mkdtemp(dir=prefetcher.dir_)
+                fetched[bundle.id] = (bundle_workspace, prefetcher.start(
+                    'lp:' + bundle.branch_spec, dir_=bundle_workspace))
+
+        try:
+            # Branch the charm as fetched, before its tests can leave
+            # files in the tree, and so bundle tests can start as soon as
+            # the charm tests finish
+            if bundles:
+                charmdir = self._deployer_branch(
+                    cache_dir or workspace, prefetcher.dir_)
+
+            envs = get_charm_test_envs()
+            charm_tests = self._multi_test(envs, constraints)
+            for env in envs:
+                if result != 'pass':
+                    break
+                result = get_test_result(charm_tests[env])
+
+            if bundles:
+                bundle_tests = self._test_bundles(
+                    bundles, fetched, constraints, cache_dir, charmdir)
+            for bundle in bundles:
                 if result == 'pass':
                     if bundle_tests[bundle.id]['result'] == 'fail':
                         result = 'fail'
+        finally:
+            if prefetcher:
+                prefetcher.close()
 
         return {
             'type': 'charm',
@@ -217,8 +441,90 @@ class CharmTester(Tester):
             }
         }
 
+    def _deployer_branch(self, cache_base, tempdir):
+        """Return a bzr branch of this charm for bundles to deploy from.
+
+        The branch is made in `tempdir`, and is shared by all bundle tests
+        of this run. Given a `cache_base` dir, branches are also kept
+        there, by charm digest, for later runs to copy instead of making
+        their own. A copy is used, not the cached branch itself, so that
+        the cache entry can be evicted while the bundle tests run.
+
+        """
+        if os.path.exists(os.path.join(self.test_dir, '.bzr')):
+            return self.test_dir
+
+        charmdir = os.path.join(
+            tempfile.mkdtemp(dir=tempdir), self.charm_name)
+        cache, key = None, FetchCache.key('deployer-branch', self.get_digest())
+        if cache_base:
+            cache = FetchCache(os.path.join(cache_base, 'deployer-branches'))
+            tree = cache.get(key)
+            if tree:
+                try:
+                    copy_tree(os.path.join(tree, self.charm_name), charmdir)
+                    log.debug('Using cached deployer branch of %s',
+                              self.charm_name)
+                    return charmdir
+                except (OSError, shutil.Error) as e:
+                    # Evicted since get()
+                    log.debug('Cached deployer branch of %s went away: %s',
+                              self.charm_name, e)
+                    shutil.rmtree(charmdir, ignore_errors=True)
+
+        make_deployer_branch(self.test_dir, charmdir)
+        if cache:
+            cache.put(key, os.path.dirname(charmdir), charm=self.charm_name)
+        return charmdir
+
+    def _test_bundles(self, bundles, fetched, constraints, cache_dir,
+                      charmdir):
+        """Test `bundles` with this charm, several at a time.
+
+        `fetched` maps bundle ids to (workspace, AsyncResult) pairs from
+        the Prefetcher, and bundles deploy the charm from the bzr branch
+        `charmdir`. Returns a dict of bundle id: test result.
+
+        """
+        def test_bundle(bundle):
+            url = 'lp:' + bundle.branch_spec
+            if get_scheduler().cancelled():
+                log.debug('Skipping bundle %s', bundle.id)
+                return bundle.id, {
+                    'type': 'bundle',
+                    'result': 'skipped',
+                    'tests': {},
+                    'url': url,
+                    'finished': timestamp(),
+                }
+            log.debug('Testing bundle %s', bundle.id)
+            bundle_workspace, bundle_fetched = fetched[bundle.id]
+            return bundle.id, test(
+                url,
+                workspace=bundle_workspace,
+                constraints=constraints,
+                cache_dir=cache_dir,
+                fetched=bundle_fetched,
+                charm_name=self.charm_name,
+                charmdir=charmdir,
+                fail_fast=self.fail_fast,
+                all_deployments=self.all_deployments)
+
+        pool = ThreadPool(min(len(bundles), get_bundle_threads()))
+        try:
+            with signal_handlers(get_scheduler()):
+                results = pool.map_async(test_bundle, bundles)
+                # Waiting without a timeout would block signal delivery
+                while not results.ready():
+                    results.wait(1)
+                return dict(results.get())
+        finally:
+            pool.close()
+            pool.join()
+
     def bundles(self):
-        bundles = [bundle for bundle in Bundles().search(self.charm_name)
+        bundles = [bundle for bundle in search_bundles(
+                   self.charm_name, self.cache_dir)
                    if bundle.promulgated and self.charm_name in bundle.charms]
         log.debug(
             'Promulgated bundles that contain %s: %s', self.charm_name,
@@ -240,15 +546,46 @@ def get_tester(test_dir):
     raise ValueError('No tester for dir: %s' % test_dir)
 
 
+def fetch(url, revision, dir_, **kw):
+    fetcher = get_fetcher(url, revision, **kw)
+    return fetcher, fetcher.fetch(dir_)
+
+
 def test(url, revision=None, shallow=False, workspace=None,
-         constraints=None, **kw):
+         constraints=None, cache_dir=None, full_clone=False, fetched=None,
+         impact=True, **kw):
+    """Fetch and test the charm or bundle at `url`.
+
+    If `fetched` is given, it's the AsyncResult of a Prefetcher that has
+    already been started for `url`.
+
+    If `impact` is True and the files changed by a merge proposal or
+    revision range (BASE..REV) are known, only the tests those changes
+    can affect are run. See `charmguardian.impact`.
+
+    """
+    # Fork the workers now, before any threads are started
+    start_scheduler()
+    # Everything a previous result must have been tested with to apply
+    options = dict(
+        kw, shallow=shallow, constraints=constraints, impact=impact,
+        charm_test_envs=get_charm_test_envs(),
+        bundle_test_envs=get_bundle_test_envs())
     tempdir = None
     try:
         tempdir = workspace or tempfile.mkdtemp()
-        fetcher = get_fetcher(url, revision)
         try:
-            test_dir = fetcher.fetch(tempdir)
+            if fetched:
+                fetcher, test_dir = fetched.get()
+            else:
+                fetcher = get_fetcher(
+                    url, revision, cache_dir=cache_dir, full_clone=full_clone)
+                previous = fetcher.previous_result(options)
+                if previous:
+                    return previous
+                test_dir = fetcher.fetch(tempdir)
         except FetchError as e:
+            events.emit('fetch-done', url=url, error=str(e))
             return {
                 'type': 'error',
                 'error': str(e),
@@ -256,21 +593,40 @@ def test(url, revision=None, shallow=False, workspace=None,
                 'url': url,
                 'finished': timestamp(),
             }
+        revision = fetcher.get_revision(test_dir)
+        events.emit('fetch-done', url=url, revision=revision)
         tester = get_tester(test_dir)
+        tester.url = url
+
+        changes = None
+        if impact:
+            files = fetcher.changed_files(test_dir)
+            if files is not None:
+                changes = analyze(files)
+                log.debug('Testing tier %s: %s',
+                          changes['tier'], changes['reason'])
 
         start = timestamp()
         result = tester.test(
             shallow=shallow,
             workspace=workspace,
             constraints=constraints,
+            cache_dir=cache_dir,
+            tier=changes['tier'] if changes else FULL,
             **kw
         )
         stop = timestamp()
 
+        if changes:
+            result['impact'] = changes
+
         result['url'] = url
-        result['revision'] = fetcher.get_revision(test_dir)
+        result['revision'] = revision
+        if fetcher.download_stats:
+            result['download'] = fetcher.download_stats
         result['started'] = start
         result['finished'] = stop
+        fetcher.record_result(result, options)
     finally:
         if tempdir and not workspace:
             shutil.rmtree(tempdir)
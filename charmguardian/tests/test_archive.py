@@ -0,0 +1,85 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+from ..archive import (
+    UnsafeArchiveError,
+    extract_zip,
+)
+
+
+def zip_member(name, mode, content=''):
+    info = zipfile.ZipInfo(name)
+    info.external_attr = mode << 16
+    return info, content
+
+
+class ExtractZipTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.dest = os.path.join(self.tempdir, 'dest')
+        os.mkdir(self.dest)
+        self.outside = os.path.join(self.tempdir, 'outside')
+        os.mkdir(self.outside)
+
+    def make_zip(self, members):
+        buf = StringIO()
+        archive = zipfile.ZipFile(buf, 'w')
+        for info, content in members:
+            archive.writestr(info, content)
+        archive.close()
+        buf.seek(0)
+        return buf
+
+    def test_symlink_escape(self):
+        for target in (self.outside, '../outside', 'a/../../outside'):
+            dest = tempfile.mkdtemp(dir=self.dest)
+            extract_zip(self.make_zip([
+                zip_member('link', stat.S_IFLNK | 0o777, target),
+                zip_member('link/x', stat.S_IFREG | 0o644, 'pwned'),
+            ]), dest)
+            self.assertFalse(os.path.islink(os.path.join(dest, 'link')))
+            self.assertEqual(os.listdir(self.outside), [])
+
+    def test_write_through_symlink(self):
+        os.symlink(self.outside, os.path.join(self.dest, 'link'))
+        self.assertRaises(UnsafeArchiveError, extract_zip, self.make_zip([
+            zip_member('link/x', stat.S_IFREG | 0o644, 'pwned'),
+        ]), self.dest)
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_extract_zip(self):
+        buf = StringIO()
+        archive = zipfile.ZipFile(buf, 'w')
+        for info, content in [
+                zip_member('meteor/', stat.S_IFDIR | 0o755),
+                zip_member('meteor/metadata.yaml', stat.S_IFREG | 0o644,
+                           'name: meteor\n'),
+                zip_member('meteor/tests/00-setup', stat.S_IFREG | 0o755,
+                           '#!/bin/sh\n'),
+                zip_member('meteor/hooks/start', stat.S_IFLNK | 0o777,
+                           'install'),
+                zip_member('meteor/README', 0, 'no mode\n'),
+        ]:
+            archive.writestr(info, content)
+        archive.close()
+        buf.seek(0)
+
+        extract_zip(buf, self.tempdir)
+
+        charm_dir = os.path.join(self.tempdir, 'meteor')
+
+        def mode(path):
+            path = os.path.join(charm_dir, path)
+            return stat.S_IMODE(os.lstat(path).st_mode)
+        self.assertEqual(mode('tests/00-setup'), 0o755)
+        self.assertEqual(mode('metadata.yaml'), 0o644)
+        self.assertEqual(
+            os.readlink(os.path.join(charm_dir, 'hooks/start')), 'install')
+        with open(os.path.join(charm_dir, 'README')) as f:
+            self.assertEqual(f.read(), 'no mode\n')
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..cache import (
+    FetchCache,
+    JsonCache,
+)
+
+
+def make_tree(parent, name, size):
+    path = os.path.join(parent, name)
+    os.makedirs(path)
+    with open(os.path.join(path, 'data'), 'w') as f:
+        f.write('x' * size)
+    return path
+
+
+class FetchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+
+    def test_put_get(self):
+        cache = FetchCache(self.cache_dir, max_size=10000)
+        key = FetchCache.key('GithubFetcher', 'https://github.com/a/b', 'abc')
+        self.assertIsNone(cache.get(key))
+
+        src = make_tree(self.tempdir, 'src', 10)
+        tree = cache.put(key, src, url='https://github.com/a/b')
+        self.assertEqual(cache.get(key), tree)
+        with open(os.path.join(tree, 'data')) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+
+    def test_key(self):
+        self.assertNotEqual(
+            FetchCache.key('GithubFetcher', 'url', '1'),
+            FetchCache.key('GithubFetcher', 'url', '2'))
+
+    def test_evict_lru(self):
+        cache = FetchCache(self.cache_dir, max_size=2500)
+        for name in ('a', 'b'):
+            cache.put(name, make_tree(self.tempdir, name, 1000))
+
+        # make 'a' the most recently used entry
+        os.utime(os.path.join(self.cache_dir, 'b'), (0, 0))
+        self.assertIsNotNone(cache.get('a'))
+
+        cache.put('c', make_tree(self.tempdir, 'c', 1000))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class JsonCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+
+    def test_get_put(self):
+        cache = JsonCache(self.tempdir)
+        self.assertIsNone(cache.get('precise/meteor'))
+        cache.put('precise/meteor', {'revision': 1}, etag='abc')
+        self.assertEqual(cache.get('precise/meteor'), {'revision': 1})
+        self.assertEqual(cache.entry('precise/meteor')['etag'], 'abc')
+        cache.delete('precise/meteor')
+        self.assertIsNone(cache.get('precise/meteor'))
+
+    @mock.patch('charmguardian.cache.time.time')
+    def test_ttl(self, time):
+        cache = JsonCache(self.tempdir, ttl=60)
+        time.return_value = 1000
+        cache.put('precise/meteor', {'revision': 1})
+
+        time.return_value = 1059
+        self.assertEqual(cache.get('precise/meteor'), {'revision': 1})
+        time.return_value = 1061
+        self.assertIsNone(cache.get('precise/meteor'))
+        self.assertIsNotNone(cache.entry('precise/meteor'))
+        self.assertEqual(
+            cache.get('precise/meteor', ttl=120), {'revision': 1})
@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from .. import charmworld
+
+
+def bundle_data(revision, **kw):
+    data = {
+        'id': '~charmers/mediawiki/{}/single'.format(revision),
+        'owner': 'charmers',
+        'basket_name': 'mediawiki',
+        'basket_revision': revision,
+        'name': 'single',
+        'promulgated': True,
+        'charm_metadata': {},
+    }
+    data.update(kw)
+    return data
+
+
+class CharmworldTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.addCleanup(charmworld._bundles.clear)
+        self.addCleanup(charmworld._searches.clear)
+
+    @mock.patch('charmguardian.charmworld.Bundle._fetch', autospec=True)
+    def test_get_bundle_memoized(self, fetch):
+        fetch.side_effect = lambda bundle, bundle_id: bundle._parse(
+            bundle_data(6))
+
+        for _ in range(2):
+            bundle = charmworld.get_bundle('mediawiki/single', self.tempdir)
+            self.assertEqual(bundle.basket_revision, 6)
+        self.assertEqual(fetch.call_count, 1)
+
+        # new process, same cache dir
+        charmworld._bundles.clear()
+        bundle = charmworld.get_bundle('mediawiki/single', self.tempdir)
+        self.assertEqual(bundle.basket_revision, 6)
+        self.assertEqual(fetch.call_count, 1)
+
+    @mock.patch('charmguardian.charmworld.Bundles')
+    @mock.patch('charmguardian.charmworld.Bundle._fetch', autospec=True)
+    def test_search_invalidates_stale(self, fetch, Bundles):
+        fetch.side_effect = lambda bundle, bundle_id: bundle._parse(
+            bundle_data(6))
+        charmworld.get_bundle('mediawiki/single', self.tempdir)
+
+        Bundles.return_value.search.return_value = [
+            charmworld.Bundle.from_bundledata(bundle_data(7))]
+        bundles = charmworld.search_bundles('mediawiki', self.tempdir)
+        self.assertEqual([b.basket_revision for b in bundles], [7])
+
+        charmworld._bundles.clear()
+        fetch.side_effect = lambda bundle, bundle_id: bundle._parse(
+            bundle_data(7))
+        bundle = charmworld.get_bundle('mediawiki/single', self.tempdir)
+        self.assertEqual(bundle.basket_revision, 7)
+        self.assertEqual(fetch.call_count, 2)
+
+        # repeated searches are served from the cache
+        charmworld._searches.clear()
+        charmworld.search_bundles('mediawiki', self.tempdir)
+        self.assertEqual(Bundles.return_value.search.call_count, 1)
+
+    def test_has_revision(self):
+        self.assertTrue(charmworld.has_revision('mediawiki/6/single'))
+        self.assertTrue(
+            charmworld.has_revision('~charmers/mediawiki/6/single'))
+        self.assertFalse(charmworld.has_revision('mediawiki/single'))
+        self.assertFalse(
+            charmworld.has_revision('~charmers/mediawiki/single'))
@@ -0,0 +1,37 @@
+import shutil
+import tempfile
+import unittest
+
+from ..deployments import (
+    DeploymentHistory,
+    choose_deployments,
+)
+
+
+class ChooseDeploymentsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+
+    def test_no_history(self):
+        self.assertIn(choose_deployments(['a', 'b']), (['a'], ['b']))
+        self.assertEqual(choose_deployments([]), [])
+
+    def test_rotation(self):
+        history = DeploymentHistory(self.tempdir)
+        deployments = ['a', 'b', 'c']
+        chosen = []
+        for i in range(3):
+            deployment = choose_deployments(deployments, history, 'bundle')
+            history.record('bundle', deployment)
+            chosen.extend(deployment)
+        self.assertEqual(sorted(chosen), deployments)
+
+    def test_least_recently_tested(self):
+        history = DeploymentHistory(self.tempdir)
+        history.cache.put('bundle', {'a': 3, 'b': 1, 'c': 2})
+        self.assertEqual(
+            choose_deployments(['a', 'b', 'c'], history, 'bundle'), ['b'])
+        self.assertEqual(
+            choose_deployments(['a', 'b', 'c', 'd'], history, 'bundle'),
+            ['d'])
@@ -0,0 +1,197 @@
+import hashlib
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import mock
+import requests
+
+from ..download import (
+    DownloadError,
+    download,
+    get,
+    get_session,
+)
+
+
+class GetSessionTest(unittest.TestCase):
+    @mock.patch('charmguardian.download._session', None)
+    @mock.patch('requests.Session')
+    def test_one_session(self, Session):
+        def slow_session():
+            time.sleep(0.05)
+            return mock.MagicMock()
+        Session.side_effect = slow_session
+
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(
+            get_session())) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(Session.call_count, 1)
+        self.assertEqual(len(set(map(id, sessions))), 1)
+
+
+class GetTest(unittest.TestCase):
+    @mock.patch('charmguardian.download.time.sleep')
+    @mock.patch('charmguardian.download.get_session')
+    def test_retry(self, get_session, sleep):
+        ok, error = mock.Mock(status_code=200), mock.Mock(status_code=503)
+        session_get = get_session.return_value.get
+        session_get.side_effect = [requests.ConnectionError(), error, ok]
+
+        self.assertIs(get('https://store.juju.ubuntu.com/charm-info'), ok)
+        self.assertEqual(session_get.call_count, 3)
+        self.assertEqual(
+            [c[0][0] for c in sleep.call_args_list], [0.5, 1.0])
+
+    @mock.patch('charmguardian.download.time.sleep')
+    @mock.patch('charmguardian.download.get_session')
+    def test_retry_closes_response(self, get_session, sleep):
+        failed = mock.Mock(status_code=503)
+        get_session.return_value.get.side_effect = [
+            failed, mock.Mock(status_code=200)]
+
+        self.assertEqual(get('http://example.com/').status_code, 200)
+        self.assertTrue(failed.close.called)
+
+    @mock.patch('charmguardian.download.time.sleep')
+    @mock.patch('charmguardian.download.get_session')
+    def test_retries_exhausted(self, get_session, sleep):
+        session_get = get_session.return_value.get
+        session_get.side_effect = requests.Timeout()
+
+        self.assertRaises(
+            requests.Timeout, get, 'https://store.juju.ubuntu.com/')
+        self.assertEqual(session_get.call_count, 4)
+
+    @mock.patch.dict('os.environ', {
+        'CHARMGUARDIAN_HTTP_TIMEOUTS': 'api.launchpad.net=60'})
+    @mock.patch('charmguardian.download.get_session')
+    def test_timeout(self, get_session):
+        session_get = get_session.return_value.get
+        session_get.return_value = mock.Mock(status_code=200)
+
+        get('https://api.launchpad.net/devel/foo')
+        get('https://store.juju.ubuntu.com/charm-info')
+
+        self.assertEqual(
+            [c[1]['timeout'] for c in session_get.call_args_list], [60, 45])
+
+
+def response(content, status_code=200, fail_after=None, **headers):
+    raw = StringIO(content)
+    if fail_after is not None:
+        def read(size, decode_content=False):
+            if raw.tell() >= fail_after:
+                raise requests.ConnectionError('connection reset')
+            return StringIO.read(raw, min(size, fail_after - raw.tell()))
+    else:
+        def read(size, decode_content=False):
+            return StringIO.read(raw, size)
+    headers.setdefault('content-length', str(len(content)))
+    return mock.Mock(
+        status_code=status_code, headers=headers, raw=mock.Mock(read=read))
+
+
+class DownloadTest(unittest.TestCase):
+    content = 'x' * 300000
+
+    @mock.patch('charmguardian.download.get')
+    def test_download(self, get):
+        get.return_value = response(self.content)
+        f = StringIO()
+
+        stats = download('http://example.com/charm', f,
+                         sha256=hashlib.sha256(self.content).hexdigest())
+
+        self.assertEqual(f.getvalue(), self.content)
+        self.assertEqual(stats['bytes'], len(self.content))
+        self.assertEqual(stats['resumes'], 0)
+
+    @mock.patch('charmguardian.download.get')
+    def test_resume(self, get):
+        get.side_effect = [
+            response(self.content, fail_after=100000),
+            response(self.content[100000:], status_code=206),
+        ]
+        f = StringIO()
+
+        stats = download('http://example.com/charm', f)
+
+        self.assertEqual(f.getvalue(), self.content)
+        self.assertEqual(stats['resumes'], 1)
+        self.assertEqual(
+            get.call_args_list[1][1]['headers'],
+            {'Range': 'bytes=100000-', 'Accept-Encoding': 'identity'})
+
+    @mock.patch('charmguardian.download.get')
+    def test_resume_encoded(self, get):
+        # A server that gzips regardless can't be resumed by byte offset
+        get.side_effect = [
+            response(self.content, fail_after=100000,
+                     **{'content-encoding': 'gzip'}),
+            response(self.content, **{'content-encoding': 'gzip'}),
+        ]
+        f = StringIO()
+
+        download('http://example.com/charm', f)
+
+        self.assertEqual(f.getvalue(), self.content)
+        self.assertNotIn('Range', get.call_args_list[1][1]['headers'])
+
+    @mock.patch('charmguardian.download.get')
+    def test_resume_connection_error(self, get):
+        get.side_effect = [
+            response(self.content, fail_after=100000),
+            requests.ConnectionError('refused'),
+        ]
+
+        self.assertRaises(
+            DownloadError, download, 'http://example.com/charm', StringIO())
+
+    @mock.patch('charmguardian.download.get')
+    def test_resume_chunked(self, get):
+        # No Content-Length at first, so the size isn't known until the
+        # resumed response's Content-Range gives it
+        first = response(self.content, fail_after=100000)
+        del first.headers['content-length']
+        get.side_effect = [
+            first,
+            response(self.content[100000:], status_code=206, **{
+                'content-range': 'bytes 100000-299999/300000'}),
+        ]
+        f = StringIO()
+
+        stats = download('http://example.com/charm', f)
+
+        self.assertEqual(f.getvalue(), self.content)
+        self.assertEqual(stats['bytes'], len(self.content))
+
+    @mock.patch('charmguardian.download.get')
+    def test_resume_unsupported(self, get):
+        get.side_effect = [
+            response(self.content, fail_after=100000),
+            response(self.content),
+        ]
+        f = StringIO()
+
+        download('http://example.com/charm', f)
+
+        self.assertEqual(f.getvalue(), self.content)
+
+    @mock.patch('charmguardian.download.get')
+    def test_checksum_mismatch(self, get):
+        get.return_value = response(self.content)
+
+        self.assertRaises(
+            DownloadError, download, 'http://example.com/charm', StringIO(),
+            sha256='0' * 64)
+
+    @mock.patch('charmguardian.download.get')
+    def test_http_error(self, get):
+        get.return_value = response('not found', status_code=404)
+
+        self.assertRaises(
+            DownloadError, download, 'http://example.com/charm', StringIO())
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..envpool import (
+    EnvPool,
+    FakeProvider,
+    get_env_pool,
+    run_leased,
+)
+
+
+def run_test():
+    return 'tested'
+
+
+class EnvPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.provider = FakeProvider(os.path.join(self.tempdir, 'fake.json'))
+
+    def pool(self, **kw):
+        return EnvPool(os.path.join(self.tempdir, 'envs'), ['local'],
+                       provider=self.provider, **kw)
+
+    def calls(self):
+        return [method for method, env in self.provider.state()['calls']]
+
+    def test_reuse(self):
+        pool = self.pool()
+        for i in range(3):
+            with pool.lease('local') as state:
+                self.assertEqual(state['uses'], i)
+        self.assertEqual(
+            self.calls(), ['bootstrap', 'reset', 'reset', 'reset'])
+
+        # A new pool, as in a later run, finds the env warm
+        with self.pool().lease('local') as state:
+            self.assertEqual(state['uses'], 3)
+
+    def test_max_uses(self):
+        pool = self.pool(max_uses=2)
+        for i in range(3):
+            with pool.lease('local'):
+                pass
+        self.assertEqual(self.calls(), [
+            'bootstrap', 'reset', 'reset', 'destroy', 'bootstrap', 'reset'])
+
+    def test_health_check_failed(self):
+        pool = self.pool()
+        with pool.lease('local'):
+            pass
+        self.provider.fail = ['is_healthy']
+        with pool.lease('local') as state:
+            self.assertEqual(state['uses'], 0)
+        self.assertEqual(self.calls(), [
+            'bootstrap', 'reset', 'destroy', 'bootstrap', 'reset'])
+
+    def test_reset_failed(self):
+        self.provider.fail = ['reset']
+        pool = self.pool()
+        with pool.lease('local'):
+            pass
+        self.assertEqual(pool.read_state('local')['bootstrapped'], None)
+        self.assertEqual(self.calls(), ['bootstrap', 'reset', 'destroy'])
+
+    def test_bootstrap_failed(self):
+        self.provider.fail = ['bootstrap']
+        with self.pool().lease('local') as state:
+            self.assertIsNone(state)
+        self.assertEqual(self.calls(), ['bootstrap'])
+
+    def test_run_leased(self):
+        self.assertEqual(run_leased(self.pool(), 'local', run_test),
+                         'tested')
+        self.assertEqual(self.calls(), ['bootstrap', 'reset'])
+
+    @mock.patch.dict('os.environ', {'CHARMGUARDIAN_WARM_ENVS': 'local, hp'})
+    def test_get_env_pool(self):
+        self.assertIsNone(get_env_pool(None))
+        self.assertEqual(get_env_pool(self.tempdir).envs, ['local', 'hp'])
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from .. import events
+from ..testers import CharmTester
+
+
+class EventsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.path = os.path.join(self.tempdir, 'events.json')
+        events.open_stream(self.path)
+        self.addCleanup(events.close_stream)
+
+    def read(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_emit(self):
+        events.emit('fetch-done', url='cs:meteor', revision='3')
+        events.close_stream()
+        events.emit('fetch-done', url='cs:ghost', revision='1')
+
+        lines = self.read()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['event'], 'fetch-done')
+        self.assertEqual(lines[0]['url'], 'cs:meteor')
+        self.assertTrue(lines[0]['time'].endswith('Z'))
+
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_charm_tester_events(self, bundletester):
+        bundletester.return_value = [{'returncode': 0}]
+        bundletester.__class__ = mock.MagicMock
+
+        test_dir = os.path.join(self.tempdir, 'charm')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name='charm'), f)
+        t = CharmTester(test_dir)
+        t.url = 'cs:charm'
+        t.bundles = lambda: []
+
+        t.test()
+        lines = self.read()
+        self.assertEqual([line['event'] for line in lines], [
+            'job-queued', 'env-started', 'test-finished', 'job-finished'])
+        self.assertEqual(len(set(line['job'] for line in lines)), 1)
+        self.assertEqual(lines[2]['record'], {'returncode': 0})
+        self.assertEqual(lines[3]['result'], 'pass')
+        self.assertEqual(lines[3]['url'], 'cs:charm')
+        self.assertFalse(lines[3]['cached'])
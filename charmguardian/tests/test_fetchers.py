@@ -1,5 +1,11 @@
+import os
+import shutil
+import tempfile
 import unittest
 
+import mock
+
+from ..cache import FetchCache
 from ..fetchers import (
     BzrFetcher,
     BzrMergeProposalFetcher,
@@ -8,6 +14,13 @@ from ..fetchers import (
     LocalFetcher,
     CharmstoreDownloader,
     BundleDownloader,
+    CachedFetcher,
+    FetchError,
+    MirrorPool,
+    check_call,
+    StoreCharm,
+    check_output,
+    parse_bzr_status,
 )
 
 
@@ -198,3 +211,245 @@ class BundleDownloaderTest(unittest.TestCase):
 
         for test in bad_tests:
             self.assertEqual(test, {})
+
+
+class CachedFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+
+    def test_fetch(self):
+        def fetch(dir_):
+            dir_ = tempfile.mkdtemp(dir=dir_)
+            with open(os.path.join(dir_, 'metadata.yaml'), 'w') as f:
+                f.write('name: meteor\n')
+            return dir_
+
+        fetcher = GithubFetcher(
+            'gh:charms/meteor', 'abc123', repo='charms/meteor')
+        fetcher.fetch = mock.Mock(side_effect=fetch)
+        fetcher.resolve_revision = lambda: 'abc123'
+        cache = FetchCache(os.path.join(self.tempdir, 'cache'))
+
+        first = CachedFetcher(fetcher, cache).fetch(self.tempdir)
+        second = CachedFetcher(fetcher, cache).fetch(self.tempdir)
+
+        self.assertEqual(fetcher.fetch.call_count, 1)
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.listdir(second), ['metadata.yaml'])
+
+    def test_fetch_uncacheable(self):
+        fetcher = LocalFetcher('local:/src', None, path='/src')
+        fetcher.fetch = mock.Mock(return_value='/dst')
+        cache = FetchCache(os.path.join(self.tempdir, 'cache'))
+
+        for _ in range(2):
+            CachedFetcher(fetcher, cache).fetch(self.tempdir)
+
+        self.assertEqual(fetcher.fetch.call_count, 2)
+        self.assertEqual(cache.entries(), [])
+
+
+class GitRemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.remote = os.path.join(self.tempdir, 'remote')
+        os.mkdir(self.remote)
+        check_call('git init -q -b master', cwd=self.remote)
+
+    def commit(self, content):
+        with open(os.path.join(self.remote, 'README'), 'w') as f:
+            f.write(content)
+        check_call('git add README', cwd=self.remote)
+        check_call(
+            'git -c user.name=test -c user.email=test@example.com '
+            'commit -q -m "{}"'.format(content), cwd=self.remote)
+        return check_output('git rev-parse HEAD', cwd=self.remote).strip()
+
+
+class GitCloneTest(GitRemoteTest):
+    def clone(self, revision, **kw):
+        dir_ = tempfile.mkdtemp(dir=self.tempdir)
+        fetcher = GithubFetcher('gh:a/b', revision, repo='a/b', **kw)
+        fetcher.git_clone('file://' + self.remote, dir_)
+        with open(os.path.join(dir_, 'README')) as f:
+            content = f.read()
+        depth = check_output('git rev-list --count HEAD', cwd=dir_)
+        return content, int(depth)
+
+    def test_shallow(self):
+        first = self.commit('one')
+        self.commit('two')
+        self.assertEqual(self.clone(first), ('one', 1))
+        self.assertEqual(self.clone('master'), ('two', 1))
+
+    def test_fallback(self):
+        self.commit('one')
+        second = self.commit('two')
+        with mock.patch.object(
+                GithubFetcher, 'git_fetch_revision',
+                side_effect=FetchError('refused')) as git_fetch_revision:
+            # A full clone, so the whole history is there
+            self.assertEqual(self.clone(second), ('two', 2))
+        git_fetch_revision.assert_called_once_with(mock.ANY, mock.ANY)
+
+    def test_abbreviated_revision(self):
+        first = self.commit('one')
+        self.commit('two')
+        self.assertEqual(self.clone(first[:7]), ('one', 1))
+        self.assertEqual(self.clone(None), ('two', 2))
+
+    def test_full_clone(self):
+        self.commit('one')
+        second = self.commit('two')
+        self.assertEqual(self.clone(second, full_clone=True), ('two', 2))
+
+
+class ChangedFilesTest(GitRemoteTest):
+    def changed_files(self, revision):
+        dir_ = tempfile.mkdtemp(dir=self.tempdir)
+        fetcher = GithubFetcher('gh:a/b', revision, repo='a/b')
+        fetcher.git_clone('file://' + self.remote, dir_)
+        return fetcher.changed_files(dir_)
+
+    def test_range(self):
+        first = self.commit('one')
+        second = self.commit('two')
+        self.assertEqual(
+            self.changed_files('{}..{}'.format(first, second)), ['README'])
+
+    def test_no_range(self):
+        self.assertEqual(self.changed_files(self.commit('one')), None)
+
+    def test_parse_bzr_status(self):
+        self.assertEqual(parse_bzr_status(
+            ' M  hooks/install\n+N  tests/10-deploy\nR   README => README.md\n'
+        ), ['hooks/install', 'tests/10-deploy', 'README', 'README.md'])
+
+
+class MirrorPoolTest(GitRemoteTest):
+    def checkout(self, pool, revision=None):
+        dir_ = tempfile.mkdtemp(dir=self.tempdir)
+        pool.git(self.remote, dir_, revision)
+        with open(os.path.join(dir_, 'README')) as f:
+            return f.read()
+
+    def test_git(self):
+        pool = MirrorPool(os.path.join(self.tempdir, 'mirrors'))
+        first = self.commit('one')
+        self.assertEqual(self.checkout(pool), 'one')
+
+        self.commit('two')
+        self.assertEqual(self.checkout(pool), 'two')
+        self.assertEqual(self.checkout(pool, first), 'one')
+        mirror = pool.mirror_path('git', self.remote)
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(mirror))),
+            [os.path.basename(mirror), os.path.basename(mirror) + '.lock'])
+
+
+class StoreCharmTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+
+    @mock.patch('charmguardian.fetchers.get')
+    def test_cached(self, get):
+        get.return_value.json.return_value = {
+            'precise/a': {'revision': 1}}
+
+        self.assertEqual(StoreCharm('precise/a', self.tempdir).revision, 1)
+        self.assertEqual(StoreCharm('precise/a', self.tempdir).revision, 1)
+        self.assertEqual(get.call_count, 1)
+
+    @mock.patch('charmguardian.fetchers.get')
+    def test_errors(self, get):
+        get.return_value.json.return_value = {
+            'precise/a': {'errors': ['entry not found']}}
+
+        self.assertRaises(ValueError, StoreCharm, 'precise/a', self.tempdir)
+        self.assertRaises(ValueError, StoreCharm, 'precise/a', self.tempdir)
+        self.assertEqual(get.call_count, 2)
+
+
+class BzrMergeProposalFetcherFetchTest(unittest.TestCase):
+    api = 'https://api.launchpad.net/devel/'
+    mp = '~me/charms/precise/foo/fix/+merge/12345'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.tips = {'target': 'rev-1', 'source': 'rev-2'}
+        self.lp = {
+            self.api + self.mp: {
+                'target_branch_link': self.api + '~charmers/target',
+                'source_branch_link': self.api + '~me/source',
+            },
+            self.api + '~charmers/target': {
+                'last_scanned_id': lambda: self.tips['target']},
+            self.api + '~me/source': {
+                'last_scanned_id': lambda: self.tips['source']},
+        }
+
+    def get(self, url, headers):
+        data = {k: v() if callable(v) else v
+                for k, v in self.lp[url].items()}
+        etag = str(hash(repr(sorted(data.items()))))
+        if headers.get('If-None-Match') == etag:
+            return mock.Mock(status_code=304)
+        return mock.Mock(
+            status_code=200, headers={'etag': etag}, json=lambda: data)
+
+    def fetcher(self):
+        return BzrMergeProposalFetcher(
+            'lp:' + self.mp, None, repo=self.mp, cache_dir=self.tempdir)
+
+    @mock.patch('charmguardian.fetchers.get')
+    def test_previous_result(self, get):
+        get.side_effect = self.get
+
+        self.assertIsNone(self.fetcher().previous_result())
+        self.fetcher().record_result({'result': 'pass'})
+        self.assertEqual(
+            self.fetcher().previous_result(),
+            {'result': 'pass', 'cached': True})
+        self.assertEqual(
+            get.call_args_list[-1][1]['headers'], {'If-None-Match': mock.ANY})
+
+        self.tips['source'] = 'rev-3'
+        self.assertIsNone(self.fetcher().previous_result())
+
+    @mock.patch('charmguardian.fetchers.get')
+    def test_previous_result_options(self, get):
+        get.side_effect = self.get
+        options = {'shallow': True, 'charm_test_envs': ['local']}
+
+        self.fetcher().record_result({'result': 'pass'}, options)
+        self.assertIsNone(self.fetcher().previous_result())
+        self.assertIsNone(self.fetcher().previous_result(
+            dict(options, charm_test_envs=['amazon'])))
+        self.assertEqual(
+            self.fetcher().previous_result(dict(options))['result'], 'pass')
+
+    @mock.patch('charmguardian.fetchers.get')
+    def test_failures_not_recorded(self, get):
+        get.side_effect = self.get
+
+        self.fetcher().record_result({'result': 'fail'})
+        self.assertIsNone(self.fetcher().previous_result())
+        self.fetcher().record_result({'result': 'pass', 'tests': {
+            'charm': {'local': [{'returncode': 0, 'skipped': True}]}}})
+        self.assertIsNone(self.fetcher().previous_result())
+
+    @mock.patch('charmguardian.fetchers.MirrorPool')
+    @mock.patch('charmguardian.fetchers.bzr')
+    @mock.patch('charmguardian.fetchers.get')
+    def test_fetch(self, get, bzr, MirrorPool):
+        get.side_effect = self.get
+
+        dir_ = self.fetcher().fetch(self.tempdir)
+
+        MirrorPool.return_value.bzr.assert_called_once_with(
+            'lp:~charmers/target', dir_)
+        bzr.assert_any_call('merge lp:~me/source', cwd=dir_)
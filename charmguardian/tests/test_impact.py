@@ -0,0 +1,37 @@
+import unittest
+
+from ..impact import (
+    CHARM,
+    FULL,
+    PROOF,
+    analyze,
+    classify,
+)
+
+
+class ImpactTest(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify('README.md'), ('docs', PROOF))
+        self.assertEqual(classify('./tests/10-deploy'), ('tests', CHARM))
+        self.assertEqual(classify('metadata.yaml'), ('metadata', FULL))
+        self.assertEqual(classify('config.yaml'), ('config', FULL))
+        self.assertEqual(classify('hooks/install'), ('hooks', FULL))
+        self.assertEqual(classify('lib/helpers.py'), ('hooks', FULL))
+
+    def test_docs_only(self):
+        impact = analyze(['README.md', 'docs/usage.rst'])
+        self.assertEqual(impact['tier'], PROOF)
+        self.assertEqual(impact['reason'], 'Only docs changed')
+        self.assertEqual(
+            impact['files'], {'docs': ['README.md', 'docs/usage.rst']})
+
+    def test_highest_tier_wins(self):
+        impact = analyze(['README.md', 'tests/10-deploy', 'hooks/install'])
+        self.assertEqual(impact['tier'], FULL)
+        self.assertEqual(impact['reason'], 'hooks changed: hooks/install')
+
+        impact = analyze(['README.md', 'tests/10-deploy'])
+        self.assertEqual(impact['tier'], CHARM)
+
+    def test_nothing_changed(self):
+        self.assertEqual(analyze([])['tier'], PROOF)
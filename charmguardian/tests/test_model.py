@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from ..model import (
+    BundleSpec,
+    CharmMetadata,
+)
+
+BUNDLE = """
+wiki:
+  services:
+    mediawiki:
+      charm: cs:precise/mediawiki-10
+    db:
+      charm: cs:precise/mysql-27
+"""
+
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.bundle_file = os.path.join(self.tempdir, 'bundles.yaml')
+        with open(self.bundle_file, 'w') as f:
+            f.write(BUNDLE)
+
+    def test_swap_charm(self):
+        spec = BundleSpec(self.tempdir)
+        self.assertEqual(spec.deployments(), ['wiki'])
+        spec.swap_charm('mysql', '/tmp/mysql')
+        spec.save()
+
+        with open(self.bundle_file) as f:
+            services = yaml.safe_load(f)['wiki']['services']
+        self.assertEqual(services['db'], {'branch': '/tmp/mysql'})
+        self.assertEqual(
+            services['mediawiki'], {'charm': 'cs:precise/mediawiki-10'})
+
+    def test_unchanged_not_written(self):
+        spec = BundleSpec(self.tempdir)
+        spec.swap_charm('haproxy', '/tmp/haproxy')
+        spec.save()
+        with open(self.bundle_file) as f:
+            self.assertEqual(f.read(), BUNDLE)
+
+    def test_charm_metadata(self):
+        with open(os.path.join(self.tempdir, 'metadata.yaml'), 'w') as f:
+            f.write('name: mysql\nsummary: MySQL\n')
+        self.assertEqual(CharmMetadata(self.tempdir).name, 'mysql')
@@ -0,0 +1,46 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..results import ResultCache
+
+
+@mock.patch('charmguardian.results.bundletester_version',
+            mock.Mock(return_value='0.12.2'))
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.results = ResultCache(self.tempdir)
+
+    def test_get_cache(self):
+        self.assertIsNone(ResultCache.get_cache(None))
+        with mock.patch('charmguardian.results.bundletester_version',
+                        return_value=None):
+            self.assertIsNone(ResultCache.get_cache(self.tempdir))
+
+    def test_key(self):
+        key = ResultCache.key('abc', 'local', deployment='d1')
+        self.assertEqual(key, ResultCache.key('abc', 'local', deployment='d1'))
+        self.assertNotEqual(key, ResultCache.key('abc', 'amazon',
+                                                 deployment='d1'))
+        self.assertNotEqual(key, ResultCache.key('abc', 'local',
+                                                 deployment='d2'))
+
+    def test_pass_cached(self):
+        key = ResultCache.key('abc', 'local')
+        self.results.put(key, [{'returncode': 0}])
+        self.assertEqual(
+            self.results.get(key), [{'returncode': 0, 'cached': True}])
+
+    def test_fail_not_cached(self):
+        key = ResultCache.key('abc', 'local')
+        self.results.put(key, [{'returncode': 1}])
+        self.assertIsNone(self.results.get(key))
+
+    def test_skipped_not_cached(self):
+        key = ResultCache.key('abc', 'local')
+        self.results.put(key, [{'returncode': 0, 'skipped': True}])
+        self.assertIsNone(self.results.get(key))
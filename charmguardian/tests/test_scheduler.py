@@ -0,0 +1,227 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from ..scheduler import (
+    PROCESS,
+    THREAD,
+    JobCancelled,
+    JobError,
+    Scheduler,
+    cancelled,
+    cleanup_on_terminate,
+    get_env_limits,
+    get_executor,
+)
+from ..util import (
+    group_alive,
+    kill,
+    stream,
+)
+
+
+def record(dir_, name):
+    """Note how many jobs are running while this one runs."""
+    path = os.path.join(dir_, name)
+    open(path, 'w').close()
+    time.sleep(0.2)
+    running = len(os.listdir(dir_))
+    os.remove(path)
+    return running
+
+
+def wait_for_cancel():
+    while not cancelled():
+        time.sleep(0.05)
+    return 'stopped'
+
+
+def run_group(dir_, stop_when_cancelled=True):
+    """Run a process group, noting its id in `dir_`/pgid, until it's
+    stopped.
+
+    """
+    p = subprocess.Popen(
+        ['setsid', 'sh', '-c', 'echo $$ > {}/pgid; sleep 60 & wait'.format(
+            dir_)],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if stop_when_cancelled:
+        return stream(p, os.path.join(dir_, 'job.log'))
+    with cleanup_on_terminate(lambda: kill(p, grace=0.5)):
+        time.sleep(60)
+
+
+def worker_id():
+    """Identify the process or thread running this job."""
+    return os.getpid(), threading.current_thread().ident
+
+
+def fail():
+    raise ValueError('boom')
+
+
+class SchedulerTest(unittest.TestCase):
+    executor = PROCESS
+
+    def scheduler(self, env_limits, max_jobs):
+        return Scheduler(env_limits, max_jobs, self.executor)
+
+    def setUp(self):
+        self.dir_ = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_)
+
+    def test_env_limit(self):
+        scheduler = self.scheduler({'local': 1}, 4)
+        jobs = [scheduler.submit('local', record, self.dir_, str(i))
+                for i in range(3)]
+        self.assertEqual([job.get() for job in jobs], [1, 1, 1])
+        scheduler.terminate()
+
+    def test_max_jobs(self):
+        scheduler = self.scheduler({}, 2)
+        jobs = [scheduler.submit(env, record, self.dir_, env)
+                for env in ('local', 'amazon', 'hp', 'azure')]
+        self.assertTrue(max(job.get() for job in jobs) <= 2)
+        self.assertEqual(scheduler.running['local'], 0)
+        scheduler.terminate()
+
+    def test_workers_reused(self):
+        scheduler = self.scheduler({}, 2)
+        scheduler.start()
+        pool = scheduler.pool
+        workers = set()
+        for i in range(4):
+            workers.add(scheduler.submit('local', worker_id).get())
+        jobs = [scheduler.submit(env, worker_id)
+                for env in ('local', 'amazon')]
+        workers.update(job.get() for job in jobs)
+        self.assertIs(scheduler.pool, pool)
+        self.assertTrue(len(workers) <= 2)
+        scheduler.terminate()
+
+    def test_pool_size(self):
+        scheduler = self.scheduler({'amazon': 6}, None)
+        scheduler.start(['local', 'amazon', 'local'])
+        self.assertEqual(len(scheduler.pool._pool), 7)
+        scheduler.terminate()
+        scheduler = self.scheduler({'amazon': 6}, 4)
+        scheduler.start(['local', 'amazon'])
+        self.assertEqual(len(scheduler.pool._pool), 4)
+        jobs = [scheduler.submit('amazon', record, self.dir_, str(i))
+                for i in range(6)]
+        self.assertTrue(max(job.get() for job in jobs) <= 4)
+        scheduler.terminate()
+
+    def test_job_ids(self):
+        scheduler = self.scheduler({}, 1)
+        other = self.scheduler({}, 1)
+        self.assertEqual(
+            [scheduler.job('local', fail).id for i in range(2)], [1, 2])
+        self.assertEqual(other.job('local', fail).id, 1)
+
+    def test_error(self):
+        scheduler = self.scheduler({}, 1)
+        job = scheduler.submit('local', fail)
+        self.assertRaises(ValueError, job.get)
+        scheduler.terminate()
+
+    def test_terminate(self):
+        scheduler = self.scheduler({'local': 1}, 1)
+        scheduler.submit('local', record, self.dir_, 'a')
+        queued = scheduler.submit('local', record, self.dir_, 'b')
+        scheduler.terminate()
+        self.assertRaises(JobError, queued.get)
+
+    def wait_for_group(self):
+        path = os.path.join(self.dir_, 'pgid')
+        while not os.path.exists(path) or not open(path).read():
+            time.sleep(0.05)
+        return int(open(path).read())
+
+    def assert_group_gone(self, pgid):
+        for _ in range(40):
+            if not group_alive(pgid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(group_alive(pgid))
+
+    def test_terminate_kills_group(self):
+        scheduler = self.scheduler({}, 1)
+        job = scheduler.submit('local', run_group, self.dir_)
+        pgid = self.wait_for_group()
+        scheduler.terminate()
+        self.assertRaises(JobError, job.get)
+        self.assert_group_gone(pgid)
+
+    @mock.patch('charmguardian.scheduler.WORKER_STOP_TIMEOUT_SECS', 0.2)
+    def test_terminate_stuck(self):
+        # The job ignores cancellation, so its worker is killed
+        scheduler = self.scheduler({}, 1)
+        scheduler.submit('local', run_group, self.dir_, False)
+        pgid = self.wait_for_group()
+        start = time.time()
+        scheduler.terminate()
+        self.assertTrue(time.time() - start < 5)
+        self.assert_group_gone(pgid)
+
+    def test_cancel(self):
+        scheduler = self.scheduler({'local': 1}, 1)
+        running = scheduler.submit('local', wait_for_cancel)
+        queued = scheduler.submit('local', wait_for_cancel)
+        scheduler.cancel()
+        self.assertEqual(running.get(), 'stopped')
+        self.assertRaises(JobCancelled, queued.get)
+        self.assertRaises(
+            JobCancelled, scheduler.submit('local', wait_for_cancel).get)
+        scheduler.terminate()
+
+
+class ThreadSchedulerTest(SchedulerTest):
+    executor = THREAD
+
+    @mock.patch('charmguardian.scheduler.THREAD_JOIN_TIMEOUT_SECS', 0.2)
+    def test_terminate_stuck(self):
+        scheduler = self.scheduler({}, 1)
+        scheduler.submit('local', time.sleep, 3)
+        time.sleep(0.1)
+        start = time.time()
+        scheduler.terminate()
+        self.assertTrue(time.time() - start < 2)
+
+
+class GetExecutorTest(unittest.TestCase):
+    def test_get_executor(self):
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.assertEqual(get_executor(), PROCESS)
+        with mock.patch.dict('os.environ', {
+                'CHARMGUARDIAN_EXECUTOR': 'thread'}):
+            self.assertEqual(get_executor(), THREAD)
+        with mock.patch.dict('os.environ', {
+                'CHARMGUARDIAN_EXECUTOR': 'fibers'}):
+            self.assertRaises(ValueError, get_executor)
+
+
+class GetEnvLimitsTest(unittest.TestCase):
+    @mock.patch.dict('os.environ', {
+        'CHARMGUARDIAN_ENV_LIMITS': 'local=1, amazon=6'})
+    def test_get_env_limits(self):
+        self.assertEqual(get_env_limits(), {'local': 1, 'amazon': 6})
+
+    def test_default_limit(self):
+        scheduler = Scheduler({'amazon': 6}, 8)
+        self.assertEqual(scheduler.limit('local'), 1)
+        self.assertEqual(scheduler.limit('amazon'), 6)
+
+    @mock.patch.dict('os.environ', {
+        'CHARMGUARDIAN_ENV_LIMITS': 'local=4',
+        'CHARMGUARDIAN_WARM_ENVS': 'local'})
+    def test_warm_env_limit(self):
+        self.assertEqual(get_env_limits(), {'local': 1})
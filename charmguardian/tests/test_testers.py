@@ -2,14 +2,27 @@ import json
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
 import mock
 
+from .. import testers
+from ..envpool import (
+    EnvPool,
+    FakeProvider,
+)
+from ..scheduler import (
+    Job,
+    Scheduler,
+)
 from ..testers import (
     BundleTester,
     CharmTester,
+    Prefetcher,
+    cancel_on_failure,
 )
+from ..util import skipped_result
 
 
 class BundleTesterTest(unittest.TestCase):
@@ -37,6 +50,44 @@ class BundleTesterTest(unittest.TestCase):
         }
         self.assertEqual(expected, result)
 
+    @mock.patch.dict('os.environ', {'BUNDLE_TEST_ENVS': 'local,amazon'})
+    @mock.patch('charmguardian.testers.get_scheduler')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_fail_fast(self, bundletester, get_scheduler):
+        bundletester.return_value = [{'returncode': 1}]
+        bundletester.__class__ = mock.MagicMock
+        scheduler = get_scheduler.return_value = Scheduler({}, 1)
+        self.addCleanup(scheduler.terminate)
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        t = BundleTester(tempdir)
+        t._choose_deployments = lambda: ['deployment1']
+
+        result = t.test(fail_fast=True)
+        self.assertEqual(result['result'], 'fail')
+        self.assertEqual(result['tests']['deployment1'], {
+            'local': [{'returncode': 1}],
+            'amazon': [skipped_result()],
+        })
+
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_all_deployments(self, bundletester):
+        bundletester.return_value = [{'returncode': 0}]
+        bundletester.__class__ = mock.MagicMock
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with open(os.path.join(tempdir, 'bundles.yaml'), 'w') as f:
+            json.dump({'one': {'services': {}}, 'two': {'services': {}}}, f)
+        t = BundleTester(tempdir)
+
+        result = t.test(all_deployments=True)
+        self.assertEqual(sorted(result['tests']), ['one', 'two'])
+
+        result = t.test()
+        self.assertEqual(len(result['tests']), 1)
+
 
 class CharmTesterTest(unittest.TestCase):
     @mock.patch('charmguardian.testers.bundletester')
@@ -65,3 +116,265 @@ class CharmTesterTest(unittest.TestCase):
             }
         }
         self.assertEqual(expected, result)
+
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_dir_renamed(self, bundletester):
+        bundletester.return_value = {}
+        bundletester.__class__ = mock.MagicMock
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        test_dir = os.path.join(tempdir, 'tmpXYZ')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name='meteor'), f)
+        t = CharmTester(test_dir)
+        t.bundles = lambda: []
+
+        t.test()
+        self.assertEqual(os.path.basename(t.test_dir), 'meteor')
+        self.assertEqual(
+            os.path.dirname(os.path.dirname(t.test_dir)), tempdir)
+        self.assertFalse(os.path.exists(test_dir))
+
+    @mock.patch('charmguardian.testers.make_deployer_branch')
+    @mock.patch('charmguardian.testers.test')
+    @mock.patch('charmguardian.testers.fetch')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_bundles(self, bundletester, fetch, test,
+                          make_deployer_branch):
+        bundletester.return_value = {}
+        bundletester.__class__ = mock.MagicMock
+        fetch.return_value = ('fetcher', '/bundle/dir')
+        test.return_value = {'result': 'fail'}
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with open(os.path.join(tempdir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name=os.path.basename(tempdir)), f)
+        t = CharmTester(tempdir)
+        bundle = mock.Mock(id='bundle1', branch_spec='~charmers/bundle')
+        t.bundles = lambda: [bundle]
+
+        result = t.test()
+        fetch.assert_called_once_with(
+            'lp:~charmers/bundle', None, mock.ANY, cache_dir=None)
+        self.assertEqual(
+            test.call_args[1]['fetched'].get(), ('fetcher', '/bundle/dir'))
+        self.assertEqual(result['result'], 'fail')
+        self.assertEqual(result['tests']['bundle'], {'bundle1': {
+            'result': 'fail'}})
+
+    @mock.patch('charmguardian.testers.make_deployer_branch')
+    @mock.patch('charmguardian.testers.test')
+    @mock.patch('charmguardian.testers.fetch')
+    def test_deployer_branch_before_tests(self, fetch, test,
+                                          make_deployer_branch):
+        def charm_tests(envs, constraints):
+            open(os.path.join(t.test_dir, 'artifact.pyc'), 'w').close()
+            return {env: [{'returncode': 0}] for env in envs}
+        fetch.return_value = ('fetcher', '/bundle/dir')
+        test.return_value = {'result': 'pass'}
+        branched = []
+        make_deployer_branch.side_effect = (
+            lambda src, dst: branched.append(sorted(os.listdir(src))))
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with open(os.path.join(tempdir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name=os.path.basename(tempdir)), f)
+        t = CharmTester(tempdir)
+        t.bundles = lambda: [
+            mock.Mock(id='bundle1', branch_spec='~charmers/bundle1')]
+        t._multi_test = charm_tests
+
+        t.test()
+        self.assertEqual(branched, [['metadata.yaml']])
+        self.assertTrue(
+            os.path.exists(os.path.join(t.test_dir, 'artifact.pyc')))
+
+    @mock.patch('charmguardian.testers.make_deployer_branch')
+    @mock.patch('charmguardian.testers.test')
+    @mock.patch('charmguardian.testers.fetch')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_bundles_concurrently(self, bundletester, fetch, test,
+                                       make_deployer_branch):
+        bundletester.return_value = {}
+        bundletester.__class__ = mock.MagicMock
+        fetch.return_value = ('fetcher', '/bundle/dir')
+        started = {'lp:~charmers/bundle1': threading.Event(),
+                   'lp:~charmers/bundle2': threading.Event()}
+
+        def test_bundle(url, **kw):
+            # Each bundle waits for the other to start
+            started[url].set()
+            concurrent = all(e.wait(5) for e in started.values())
+            return {'result': 'pass' if concurrent else 'fail',
+                    'workspace': kw['workspace']}
+        test.side_effect = test_bundle
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with open(os.path.join(tempdir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name=os.path.basename(tempdir)), f)
+        t = CharmTester(tempdir)
+        t.bundles = lambda: [
+            mock.Mock(id='bundle1', branch_spec='~charmers/bundle1'),
+            mock.Mock(id='bundle2', branch_spec='~charmers/bundle2')]
+
+        result = t.test()
+        bundle_tests = result['tests']['bundle']
+        self.assertEqual(sorted(bundle_tests), ['bundle1', 'bundle2'])
+        self.assertNotEqual(bundle_tests['bundle1']['workspace'],
+                            bundle_tests['bundle2']['workspace'])
+        self.assertEqual(result['result'], 'pass')
+
+    @mock.patch('charmguardian.testers.charm_proof')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_proof_only(self, bundletester, charm_proof):
+        charm_proof.return_value = {'returncode': 0}
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with open(os.path.join(tempdir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name=os.path.basename(tempdir)), f)
+        t = CharmTester(tempdir)
+
+        result = t.test(tier='proof')
+        self.assertFalse(bundletester.called)
+        self.assertEqual(result, {
+            'type': 'charm',
+            'result': 'pass',
+            'tests': {
+                'charm': {'proof': [{'returncode': 0}]},
+                'bundle': {},
+            },
+        })
+
+    @mock.patch('charmguardian.results.bundletester_version')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_cached(self, bundletester, bundletester_version):
+        bundletester.return_value = [{'returncode': 0}]
+        bundletester.__class__ = mock.MagicMock
+        bundletester_version.return_value = '0.12.2'
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        cache_dir = os.path.join(tempdir, 'cache')
+        test_dir = os.path.join(tempdir, 'charm')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name='charm'), f)
+
+        def test():
+            t = CharmTester(test_dir)
+            t.bundles = lambda: []
+            return t.test(cache_dir=cache_dir)['tests']['charm']['local']
+
+        self.assertEqual(test(), [{'returncode': 0}])
+        self.assertEqual(test(), [{'returncode': 0, 'cached': True}])
+
+    @mock.patch('charmguardian.testers.get_env_pool')
+    @mock.patch('charmguardian.testers.bundletester')
+    def test_test_warm_env(self, bundletester, get_env_pool):
+        bundletester.return_value = [{'returncode': 0}]
+        bundletester.__class__ = mock.MagicMock
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        provider = FakeProvider(os.path.join(tempdir, 'fake.json'))
+        get_env_pool.return_value = EnvPool(
+            os.path.join(tempdir, 'envs'), ['local'], provider=provider)
+        test_dir = os.path.join(tempdir, 'charm')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name='charm'), f)
+        t = CharmTester(test_dir)
+        t.bundles = lambda: []
+
+        result = t.test()
+        self.assertEqual(result['result'], 'pass')
+        self.assertEqual(provider.state()['calls'], [
+            ['bootstrap', 'local'], ['reset', 'local']])
+
+    @mock.patch('charmguardian.testers.make_deployer_branch')
+    def test_deployer_branch(self, make_deployer_branch):
+        make_deployer_branch.side_effect = lambda src, dst: os.makedirs(
+            os.path.join(dst, '.bzr'))
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        test_dir = os.path.join(tempdir, 'charm')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'metadata.yaml'), 'w') as f:
+            json.dump(dict(name='charm'), f)
+        cache_dir = os.path.join(tempdir, 'cache')
+
+        branches = []
+        for i in range(2):
+            t = CharmTester(test_dir)
+            branches.append(t._deployer_branch(cache_dir, tempdir))
+        self.assertEqual(make_deployer_branch.call_count, 1)
+        for branch in branches:
+            self.assertEqual(os.path.basename(branch), 'charm')
+            self.assertTrue(os.path.isdir(os.path.join(branch, '.bzr')))
+            # A copy, which the cache can't evict from under the tests
+            self.assertFalse(branch.startswith(cache_dir))
+
+        # The cache entry going away doesn't stop the branch being made
+        shutil.rmtree(os.path.join(cache_dir, 'deployer-branches'))
+        t = CharmTester(test_dir)
+        self.assertTrue(os.path.isdir(os.path.join(
+            t._deployer_branch(cache_dir, tempdir), '.bzr')))
+        self.assertEqual(make_deployer_branch.call_count, 2)
+
+
+class PrefetcherTest(unittest.TestCase):
+    @mock.patch('charmguardian.testers.ThreadPool')
+    @mock.patch('charmguardian.testers.get_scheduler')
+    def test_workers_forked_first(self, get_scheduler, ThreadPool):
+        calls = []
+        get_scheduler.return_value.start.side_effect = (
+            lambda envs: calls.append(('start workers', envs)))
+        ThreadPool.side_effect = lambda threads: calls.append('threads')
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        with mock.patch.dict('os.environ', {
+                'CHARM_TEST_ENVS': 'local,amazon',
+                'BUNDLE_TEST_ENVS': 'amazon'}):
+            Prefetcher(tempdir)
+        self.assertEqual(calls, [
+            ('start workers', ['local', 'amazon', 'amazon']), 'threads'])
+
+
+class CancelOnFailureTest(unittest.TestCase):
+    @mock.patch('charmguardian.testers.get_scheduler')
+    def test_cancels_own_scheduler(self, get_scheduler):
+        scheduler = Scheduler({}, 1)
+        self.addCleanup(scheduler.terminate)
+        job = Job('local', None, (), {})
+        job.scheduler = scheduler
+        job.set_result((True, [{'returncode': 1}], None))
+
+        cancel_on_failure(job)
+        self.assertTrue(scheduler.cancelled())
+        self.assertFalse(get_scheduler.return_value.cancel.called)
+
+
+class TestTest(unittest.TestCase):
+    @mock.patch('charmguardian.testers.get_tester')
+    @mock.patch('charmguardian.testers.get_fetcher')
+    def test_revision(self, get_fetcher, get_tester):
+        fetcher = get_fetcher.return_value
+        fetcher.previous_result.return_value = None
+        fetcher.changed_files.return_value = None
+        fetcher.download_stats = None
+        fetcher.get_revision.return_value = '7'
+        get_tester.return_value.test.return_value = {'result': 'pass'}
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tempdir))
+        result = testers.test('cs:meteor', workspace=tempdir)
+        self.assertEqual(result['revision'], '7')
+        self.assertEqual(fetcher.get_revision.call_count, 1)
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..tree import (
+    copy_tree,
+    move_tree,
+    tree_digest,
+)
+
+
+class TreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.src = os.path.join(self.tempdir, 'src')
+        os.makedirs(os.path.join(self.src, 'hooks'))
+        with open(os.path.join(self.src, 'hooks', 'install'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.symlink('install', os.path.join(self.src, 'hooks', 'start'))
+
+    def assertTree(self, path):
+        with open(os.path.join(path, 'hooks', 'install')) as f:
+            self.assertEqual(f.read(), '#!/bin/sh\n')
+        self.assertEqual(
+            os.readlink(os.path.join(path, 'hooks', 'start')), 'install')
+
+    def test_copy_tree(self):
+        dst = os.path.join(self.tempdir, 'dst')
+        self.assertIn(copy_tree(self.src, dst), ('reflink', 'copy'))
+        self.assertTree(self.src)
+        self.assertTree(dst)
+
+        with open(os.path.join(dst, 'hooks', 'install'), 'w') as f:
+            f.write('changed')
+        self.assertTree(self.src)
+
+    def test_move_tree(self):
+        dst = os.path.join(self.tempdir, 'dst')
+        self.assertEqual(move_tree(self.src, dst), 'rename')
+        self.assertFalse(os.path.exists(self.src))
+        self.assertTree(dst)
+
+    def test_tree_digest(self):
+        digest = tree_digest(self.src)
+        dst = os.path.join(self.tempdir, 'dst')
+        copy_tree(self.src, dst)
+        self.assertEqual(tree_digest(dst), digest)
+
+        install = os.path.join(dst, 'hooks', 'install')
+        os.chmod(install, 0o755)
+        self.assertNotEqual(tree_digest(dst), digest)
+        os.chmod(install, 0o644)
+        self.assertEqual(tree_digest(dst), digest)
+
+        with open(install, 'w') as f:
+            f.write('#!/bin/bash\n')
+        self.assertNotEqual(tree_digest(dst), digest)
+
+    def test_tree_digest_ignore(self):
+        digest = tree_digest(self.src)
+        os.makedirs(os.path.join(self.src, '.git', 'objects'))
+        with open(os.path.join(self.src, 'result-x.json'), 'w') as f:
+            f.write('{}')
+        self.assertEqual(
+            tree_digest(self.src, ['.git', 'result-*.json']), digest)
+
+    def test_tree_digest_dir_order(self):
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.src, name, 'sub'))
+            with open(os.path.join(self.src, name, 'sub', 'f'), 'w') as f:
+                f.write(name)
+
+        real_listdir = os.listdir
+        digests = set()
+        for reverse in (False, True):
+            with mock.patch('os.listdir', lambda path: sorted(
+                    real_listdir(path), reverse=reverse)):
+                digests.add(tree_digest(self.src))
+        self.assertEqual(len(digests), 1)
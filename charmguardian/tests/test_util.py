@@ -0,0 +1,167 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import mock
+
+from ..util import (
+    Timeout,
+    bundletester,
+    group_alive,
+    juju_env,
+    kill,
+    stream,
+)
+
+FAKE_BUNDLETESTER = """#!/bin/sh
+echo "deploying $@ in $JUJU_ENV"
+while [ "$1" != "-o" ]; do shift; done
+echo '[{"returncode": 0}]' > $2
+"""
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        self.log_file = os.path.join(self.tempdir, 'job.log')
+
+    def popen(self, script):
+        return subprocess.Popen(
+            ['sh', '-c', script],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    @mock.patch('sys.stderr', new_callable=StringIO)
+    def test_stream(self, stderr):
+        p = self.popen('echo one; echo two >&2; printf three')
+        output = stream(p, self.log_file, '[local] ')
+        self.assertEqual(output, 'one\ntwo\nthree')
+        self.assertEqual(
+            stderr.getvalue(), '[local] one\n[local] two\n[local] three\n')
+        with open(self.log_file) as f:
+            self.assertEqual(f.read(), output)
+
+    def test_exit_noticed(self):
+        start = time.time()
+        stream(self.popen('true'), self.log_file)
+        self.assertTrue(time.time() - start < 0.4)
+
+    @mock.patch('charmguardian.util.cancelled', return_value=True)
+    def test_cancelled(self, cancelled):
+        p = self.popen('sleep 10')
+        self.assertIsNone(stream(p, self.log_file))
+        self.assertIsNotNone(p.returncode)
+
+    def test_timeout(self):
+        p = self.popen('echo started; sleep 10')
+        with self.assertRaises(Timeout) as cm:
+            stream(p, self.log_file, timeout=0.5)
+        self.assertEqual(cm.exception.output, 'started\n')
+        self.assertIsNotNone(p.returncode)
+
+    def test_idle_timeout(self):
+        start = time.time()
+        p = self.popen('while true; do echo .; sleep 0.1; done')
+        with self.assertRaises(Timeout):
+            stream(p, self.log_file, timeout=1.5, idle_timeout=0.5)
+        # Timed out by the overall limit, as output kept coming
+        self.assertTrue(time.time() - start >= 1.5)
+
+        p = self.popen('echo started; sleep 10')
+        with self.assertRaises(Timeout) as cm:
+            stream(p, self.log_file, idle_timeout=0.5)
+        self.assertIn('without output', str(cm.exception))
+
+    def test_rusage(self):
+        p = self.popen('i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done')
+        stream(p, self.log_file)
+        self.assertEqual(p.returncode, 0)
+        self.assertTrue(p.rusage.ru_utime + p.rusage.ru_stime > 0)
+        self.assertTrue(p.rusage.ru_maxrss > 0)
+
+    def test_kill_group(self):
+        pid_file = os.path.join(self.tempdir, 'pid')
+        # The child ignores SIGTERM, so outlives its parent
+        p = subprocess.Popen(
+            ['sh', '-c', "(trap '' TERM; echo $$ > {}; sleep 30) & wait"
+             .format(pid_file)],
+            preexec_fn=os.setsid)
+        while not os.path.exists(pid_file) or not open(pid_file).read():
+            time.sleep(0.05)
+        kill(p, grace=0.5)
+        self.assertIsNotNone(p.returncode)
+        for _ in range(40):
+            if not group_alive(p.pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(group_alive(p.pid))
+
+
+class BundletesterTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+        bin_dir = os.path.join(self.tempdir, 'bin')
+        os.mkdir(bin_dir)
+        script = os.path.join(bin_dir, 'bundletester')
+        with open(script, 'w') as f:
+            f.write(FAKE_BUNDLETESTER)
+        os.chmod(script, 0o755)
+        patcher = mock.patch.dict('os.environ', {
+            'PATH': bin_dir + os.pathsep + os.environ['PATH']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bundletester(self):
+        test_dir = os.path.join(self.tempdir, 'charm')
+        os.mkdir(test_dir)
+        results = bundletester(test_dir, 'local')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['returncode'], 0)
+        resources = results[0]['resources']
+        self.assertEqual(sorted(resources), [
+            'cpu_secs', 'disk_peak_bytes', 'max_rss_kb', 'wall_secs'])
+        self.assertIsNotNone(resources['cpu_secs'])
+        logs = [name for name in os.listdir(test_dir)
+                if name.startswith('bundletester-')]
+        with open(os.path.join(test_dir, logs[0])) as f:
+            output = f.read()
+        self.assertTrue(output.startswith('deploying '))
+        self.assertTrue(output.strip().endswith('in local'))
+        self.assertNotEqual(os.environ.get('JUJU_ENV'), 'local')
+
+    def test_bundletester_group(self):
+        stat_file = os.path.join(self.tempdir, 'stat')
+        script = os.path.join(self.tempdir, 'bin', 'bundletester')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncat /proc/$$/stat > {}\n'.format(stat_file))
+        test_dir = os.path.join(self.tempdir, 'charm')
+        os.mkdir(test_dir)
+        bundletester(test_dir, 'local')
+        with open(stat_file) as f:
+            fields = f.read().split()
+        # It leads its own process group
+        self.assertEqual(fields[0], fields[4])
+
+    @mock.patch.dict('os.environ', {'CHARMGUARDIAN_JOB_TIMEOUT': '1'})
+    def test_bundletester_timeout(self):
+        script = os.path.join(self.tempdir, 'bin', 'bundletester')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\necho "deploying $@"\nsleep 30\n')
+        test_dir = os.path.join(self.tempdir, 'charm')
+        os.mkdir(test_dir)
+        results = bundletester(test_dir, 'local')
+        self.assertNotEqual(results[0]['returncode'], 0)
+        self.assertIn('timed out after 1s', results[0]['output'])
+
+
+class JujuEnvTest(unittest.TestCase):
+    def test_juju_env(self):
+        environ = {'JUJU_ENV': 'amazon', 'HOME': '/home/ubuntu'}
+        self.assertEqual(juju_env('local', environ), {
+            'JUJU_ENV': 'local', 'HOME': '/home/ubuntu'})
+        self.assertEqual(environ['JUJU_ENV'], 'amazon')
@@ -0,0 +1,117 @@
+import errno
+import fnmatch
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import subprocess
+
+log = logging.getLogger(__name__)
+
+# st_dev pairs between which reflinks have been found not to work
+_no_reflink = set()
+
+# path: (stat signature, sha1 of contents) of files already digested
+_file_digests = {}
+
+
+def copy_tree(src, dst):
+    """Copy the directory tree at `src` to `dst`, which must not exist.
+
+    Where the filesystem supports it (btrfs, xfs, ...) the copy is made
+    with reflinks, so file data is shared copy-on-write with `src` and
+    only metadata is written. Otherwise falls back to a regular copy.
+
+    Returns the method used, 'reflink' or 'copy'.
+
+    """
+    devs = (os.stat(src).st_dev,
+            os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    if devs not in _no_reflink:
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    ['cp', '-a', '--reflink=always', src, dst],
+                    stdout=devnull, stderr=devnull)
+            return 'reflink'
+        except (OSError, subprocess.CalledProcessError):
+            log.debug('Reflinks not supported from %s to %s', src, dst)
+            _no_reflink.add(devs)
+            shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst, symlinks=True)
+    return 'copy'
+
+
+def move_tree(src, dst):
+    """Move the directory tree at `src` to `dst`, which must not exist.
+
+    This is a rename if both are on the same filesystem, otherwise
+    `src` is copied to `dst` and then removed.
+
+    Returns the method used, 'rename', 'reflink' or 'copy'.
+
+    """
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method = copy_tree(src, dst)
+    shutil.rmtree(src)
+    return method
+
+
+def file_digest(path, st):
+    """Return the sha1 of the file at `path`, whose lstat is `st`.
+
+    Files whose size, times and inode are unchanged since they were last
+    digested aren't read again.
+
+    """
+    signature = (st.st_size, st.st_mtime, st.st_ctime, st.st_ino)
+    cached = _file_digests.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    _file_digests[path] = (signature, h.hexdigest())
+    return h.hexdigest()
+
+
+def tree_digest(path, ignore=()):
+    """Return a digest of the names, contents, symlink targets and exec
+    bits of the files in the tree at `path`.
+
+    Paths relative to `path` that match a pattern in `ignore` are left
+    out, as are their contents if they're dirs.
+
+    """
+    def ignored(rel):
+        return any(fnmatch.fnmatch(rel, pattern) for pattern in ignore)
+
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        entries = []
+        for name in dirs + files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if not ignored(rel):
+                entries.append((rel, os.path.join(root, name)))
+        # Visit subdirs in a fixed order, not the order they're on disk
+        dirs[:] = sorted(name for name in dirs if not ignored(
+            os.path.normpath(os.path.join(rel_root, name))))
+        for rel, full in sorted(entries):
+            st = os.lstat(full)
+            if stat.S_ISLNK(st.st_mode):
+                data = 'l ' + os.readlink(full)
+            elif stat.S_ISDIR(st.st_mode):
+                data = 'd'
+            else:
+                data = 'f {:o} {}'.format(
+                    st.st_mode & 0o111, file_digest(full, st))
+            h.update('{}\0{}\0'.format(rel, data))
+    return h.hexdigest()
@@ -1,17 +1,54 @@
-from contextlib import contextmanager
 from datetime import datetime
 import logging
 import json
 import os
+import select
 import shlex
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
+from .cache import tree_size
+from .scheduler import (
+    cancelled,
+    cleanup_on_terminate,
+)
 
 log = logging.getLogger(__name__)
 
+# How often a running job checks whether it has been cancelled
+CANCEL_CHECK_SECS = 0.5
+# How long a killed process group gets to exit before SIGKILL
+KILL_GRACE_SECS = 10
+# How often the disk usage of a running job is sampled
+DISK_CHECK_SECS = 10
+
+JOB_TIMEOUT = 3 * 60 * 60
+IDLE_TIMEOUT = 0
+
+
+def get_job_timeout():
+    """Max seconds a bundletester run may take; 0 for no limit."""
+    return int(os.environ.get('CHARMGUARDIAN_JOB_TIMEOUT', JOB_TIMEOUT))
+
+
+def get_idle_timeout():
+    """Max seconds a bundletester run may go without output; 0 for no
+    limit.
+
+    """
+    return int(os.environ.get('CHARMGUARDIAN_IDLE_TIMEOUT', IDLE_TIMEOUT))
+
+
+class Timeout(Exception):
+    """A process was killed for running, or being silent, too long."""
+    def __init__(self, msg, output):
+        super(Timeout, self).__init__(msg)
+        self.output = output
+
 
 def bundletester(dir_, env, deployment=None, exclude=None,
                  skip_implicit=False, constraints=None):
@@ -21,81 +58,310 @@ def bundletester(dir_, env, deployment=None, exclude=None,
     except OSError:
         pass
 
-    with juju_env(env):
-        debug = log.getEffectiveLevel() == logging.DEBUG
-
-        _, result_file = tempfile.mkstemp(
-            prefix='result-', suffix='.json', dir=dir_)
-        log_level = 'DEBUG' if debug else 'ERROR'
-
-        cmd = 'bundletester -F -r json -t {} -e {} -o {} -l {}'.format(
-            dir_, env, result_file, log_level)
-        if deployment:
-            cmd = '{} -d {}'.format(cmd, deployment)
-        if exclude:
-            cmd = '{} -x {}'.format(cmd, exclude)
-        if skip_implicit:
-            cmd = '{} -s'.format(cmd)
-        if log_level == 'DEBUG':
-            cmd = '{} -v'.format(cmd)
-        if constraints:
-            cmd = '{} --constraints "{}"'.format(cmd, constraints)
-        args = shlex.split(cmd)
-        output = ''
-
-        log.debug('Running bundletester: %s', cmd)
-        with tempfile.NamedTemporaryFile() as writer:
-            with open(writer.name, 'rb', 1) as reader:
-                p = subprocess.Popen(
-                    args,
-                    stdout=writer,
-                    stderr=subprocess.STDOUT,
-                    cwd=proc_cwd,
-                )
-                while p.poll() is None:
-                    if debug:
-                        sys.stderr.write(reader.read())
-                    time.sleep(0.5)
-                if debug:
-                    sys.stderr.write(reader.read())
-                reader.seek(0)
-                output = reader.read()
+    watcher = DiskWatcher(proc_cwd)
+    debug = log.getEffectiveLevel() == logging.DEBUG
 
-        try:
-            with open(result_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            log.exception(e)
-
-        err_result = {
-            "executable": [cmd],
-            "returncode": p.returncode,
-            "duration": 0.0,
-            "suite": "",
-            "test": "",
-            "output": "bundletester failed:\n{}".format(output),
-            "dirname": dir_,
-        }
-
-        if p.returncode == 3:
-            err_result['output'] = "No tests found"
-            err_result['returncode'] = 0
-
-        return [err_result]
-
-
-@contextmanager
-def juju_env(env):
-    orig_env = os.environ.get('JUJU_ENV', '')
-    if env != orig_env:
-        log.debug('Updating JUJU_ENV: "%s" -> "%s"', orig_env, env)
-        os.environ['JUJU_ENV'] = env
+    fd, result_file = tempfile.mkstemp(
+        prefix='result-', suffix='.json', dir=dir_)
+    os.close(fd)
+    log_level = 'DEBUG' if debug else 'ERROR'
+
+    cmd = 'bundletester -F -r json -t {} -e {} -o {} -l {}'.format(
+        dir_, env, result_file, log_level)
+    if deployment:
+        cmd = '{} -d {}'.format(cmd, deployment)
+    if exclude:
+        cmd = '{} -x {}'.format(cmd, exclude)
+    if skip_implicit:
+        cmd = '{} -s'.format(cmd)
+    if log_level == 'DEBUG':
+        cmd = '{} -v'.format(cmd)
+    if constraints:
+        cmd = '{} --constraints "{}"'.format(cmd, constraints)
+    args = shlex.split(cmd)
+
+    fd, log_file = tempfile.mkstemp(
+        prefix='bundletester-', suffix='.log', dir=dir_)
+    os.close(fd)
+    prefix = '[{}] '.format(
+        ' '.join(filter(None, [env, deployment])))
+    log.debug('Running bundletester: %s (log: %s)', cmd, log_file)
+    start = time.time()
+    # In its own process group, so that a timeout can kill everything
+    # it started. setsid(1) execs in place, so p.pid leads the group.
+    # (preexec_fn isn't safe to use while other threads are running.)
+    p = subprocess.Popen(
+        ['setsid'] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=proc_cwd,
+        env=juju_env(env),
+        # Don't let it hold the pipes of jobs running in other threads
+        close_fds=True,
+    )
+    watcher.start()
     try:
-        yield
+        with cleanup_on_terminate(lambda: kill(p)):
+            output = stream(
+                p, log_file, prefix if debug else None,
+                timeout=get_job_timeout(), idle_timeout=get_idle_timeout())
+    except Timeout as e:
+        log.debug('bundletester %s', e)
+        output = 'bundletester {}:\n{}'.format(e, e.output)
     finally:
-        if env != orig_env:
-            log.debug('Updating JUJU_ENV: "%s" -> "%s"', env, orig_env)
-            os.environ['JUJU_ENV'] = orig_env
+        watcher.stop()
+    if output is None:
+        return [skipped_result(cmd)]
+    resources = get_resources(p, start, watcher.peak)
+
+    try:
+        with open(result_file, 'r') as f:
+            results = json.load(f)
+        for result in results:
+            result['resources'] = resources
+        return results
+    except Exception as e:
+        log.exception(e)
+
+    err_result = {
+        "executable": [cmd],
+        "returncode": p.returncode,
+        "duration": resources['wall_secs'],
+        "suite": "",
+        "test": "",
+        "output": "bundletester failed:\n{}".format(output),
+        "dirname": dir_,
+        "resources": resources,
+    }
+
+    if p.returncode == 3:
+        err_result['output'] = "No tests found"
+        err_result['returncode'] = 0
+
+    return [err_result]
+
+
+def get_resources(p, start, disk_peak):
+    """Return the resources used by process `p` and its children.
+
+    CPU time and max RSS only count the children that were waited for.
+
+    """
+    usage = getattr(p, 'rusage', None)
+    return {
+        'wall_secs': round(time.time() - start, 3),
+        'cpu_secs': round(usage.ru_utime + usage.ru_stime, 3)
+        if usage else None,
+        'max_rss_kb': usage.ru_maxrss if usage else None,
+        'disk_peak_bytes': disk_peak,
+    }
+
+
+class DiskWatcher(threading.Thread):
+    """Samples the size of the tree at `path` until stopped, keeping the
+    largest size seen in `peak`.
+
+    The size is the sum of the files' apparent sizes, from lstat(). A
+    symlink counts as the link itself, not what it points to, and data
+    shared through hard links or reflinks counts in full. Growth between
+    samples that's gone by the next one is missed.
+
+    """
+    def __init__(self, path, interval=DISK_CHECK_SECS):
+        super(DiskWatcher, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        try:
+            self.peak = max(self.peak, tree_size(self.path))
+        except OSError:
+            # Files come and go while a test runs
+            pass
+
+    def run(self):
+        while True:
+            self.sample()
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        if self.is_alive():
+            self._stop_event.set()
+            self.join()
+        self.sample()
+
+
+def stream(p, log_file, prefix=None, timeout=None, idle_timeout=None):
+    """Collect the output of process `p` as it's written.
+
+    The output is teed to `log_file` and, if `prefix` is given, echoed
+    to stderr one line at a time with `prefix` at the start of each line,
+    so that the output of concurrent jobs can be told apart.
+
+    Returns the output once `p` exits, or None if the job was cancelled.
+    Raises Timeout if `p` runs for more than `timeout` seconds, or writes
+    nothing for `idle_timeout` seconds. Either way `p` is killed, with
+    its process group if it leads one.
+
+    """
+    out = p.stdout.fileno()
+    chunks, partial = [], ''
+    start = last_output = time.time()
+    with open(log_file, 'ab') as log_f:
+        while True:
+            ready, _, _ = select.select([out], [], [], CANCEL_CHECK_SECS)
+            now = time.time()
+            if cancelled():
+                log.debug('Stopping pid %s', p.pid)
+                kill(p)
+                return None
+            if timeout and now - start > timeout:
+                kill(p)
+                raise Timeout('timed out after {}s'.format(timeout),
+                              ''.join(chunks))
+            if idle_timeout and now - last_output > idle_timeout:
+                kill(p)
+                raise Timeout('timed out after {}s without output'.format(
+                    idle_timeout), ''.join(chunks))
+            if not ready:
+                if wait(p, block=False) is not None:
+                    # Exited, but a child of its own holds the pipe open
+                    break
+                continue
+            chunk = os.read(out, 64 * 1024)
+            if not chunk:
+                break
+            last_output = now
+            chunks.append(chunk)
+            log_f.write(chunk)
+            log_f.flush()
+            if prefix is not None:
+                lines = (partial + chunk).split('\n')
+                partial = lines.pop()
+                if lines:
+                    sys.stderr.write(''.join(
+                        prefix + line + '\n' for line in lines))
+    if prefix is not None and partial:
+        sys.stderr.write(prefix + partial + '\n')
+    p.stdout.close()
+    wait(p)
+    return ''.join(chunks)
+
+
+def wait(p, block=True):
+    """Reap process `p`, returning its returncode, or None if `block` is
+    False and it's still running.
+
+    Unlike Popen.wait(), keeps the resource usage of `p` and its children
+    in `p.rusage`.
+
+    """
+    if p.returncode is not None:
+        return p.returncode
+    pid, status, rusage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    p.rusage = rusage
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return p.returncode
+
+
+def kill(p, grace=KILL_GRACE_SECS):
+    """Stop process `p` and the rest of its process group, if it leads
+    one: SIGTERM, then SIGKILL after `grace` seconds.
+
+    """
+    try:
+        group = os.getpgid(p.pid) == p.pid
+    except OSError:
+        group = False
+
+    def send(sig):
+        try:
+            if group:
+                os.killpg(p.pid, sig)
+            elif p.returncode is None:
+                os.kill(p.pid, sig)
+        except OSError:
+            # Already gone
+            pass
+
+    send(signal.SIGTERM)
+    deadline = time.time() + grace
+    while wait(p, block=False) is None and time.time() < deadline:
+        time.sleep(0.1)
+    if p.returncode is None:
+        # Not reaped, so its pid, and the group's id, can't be reused yet
+        send(signal.SIGKILL)
+        wait(p)
+    elif group and group_alive(p.pid):
+        # Children that outlived `p`
+        send(signal.SIGKILL)
+
+
+def group_alive(pgid):
+    """Return True if process group `pgid` has any members left."""
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def charm_proof(dir_):
+    """Run `charm proof` on `dir_`, returning a bundletester-style record."""
+    cmd = 'charm proof'
+    start = time.time()
+    try:
+        p = subprocess.Popen(
+            shlex.split(cmd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=dir_,
+        )
+        output, _ = p.communicate()
+        returncode = p.returncode
+    except OSError as e:
+        output, returncode = 'charm proof failed: {}'.format(e), 1
+    return {
+        "executable": [cmd],
+        "returncode": returncode,
+        "duration": time.time() - start,
+        "suite": os.path.basename(dir_.rstrip('/')),
+        "test": "charm-proof",
+        "output": output,
+        "dirname": dir_,
+    }
+
+
+def skipped_result(cmd=None):
+    """Return a bundletester-style record for a test that was cancelled."""
+    return {
+        "executable": [cmd] if cmd else [],
+        "returncode": 0,
+        "duration": 0.0,
+        "suite": "",
+        "test": "",
+        "output": "Skipped: cancelled after another test failed",
+        "skipped": True,
+    }
+
+
+def juju_env(env, environ=None):
+    """Return a copy of `environ` (default: os.environ) that selects Juju
+    environment `env`, to pass to subprocesses.
+
+    """
+    environ = dict(os.environ if environ is None else environ)
+    environ['JUJU_ENV'] = env
+    return environ
 
 
 def get_envs(env_var):
@@ -115,6 +381,10 @@ def timestamp():
     return datetime.utcnow().isoformat() + 'Z'
 
 
+def is_skipped(tests):
+    return bool(tests) and all(test.get('skipped') for test in tests)
+
+
 def get_test_result(tests):
     for test in tests:
         if test.get('returncode', 0) != 0: